@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+# ==============================================================================
+# @ Author :
+# @ Desc : asyncio抓取入口(单个事件循环驱动多个IMAP连接, 保存在线程池中进行)
+# @ Date : 2021/6/8
+# ==============================================================================
+import asyncio
+import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+from concurrent_run import split_ids
+from fetch_core.aio_outlook import AsyncEmailInfoFetch
+from fetch_core.checkpoint import SyncCheckpoint
+from fetch_core.config import EMAIL_USERNAME, EMAIL_PASSWORD, SYNC_MODE, FETCH_CONCURRENCY, AIO_MAX_PENDING_SAVES
+from fetch_core.db import DBManagement, ReportBatchWriter, attachment_index
+from fetch_core.extractor import extractor_pool
+from fetch_core.outlook import EmailInfoFetch
+from fetch_core.spool import attachment_spool
+from fetch_core.tencentyun import cos_uploader
+from utils.es_tokenizer import es_tokenizer
+from utils.init_logger import get_logger
+
+logger = get_logger("aio_fetch")
+
+
+def save_message(message, latest_report_time, writer, db_manager, prefiltered=True):
+    """
+    抓取并保存单封邮件(在线程池中执行, 与网络读取并行)
+
+    :param message: 已下载的 email.message.Message
+    :param datetime.datetime latest_report_time: 数据库最新保存研报的发件时间
+    :param writer: 批量写入器
+    :param db_manager: 共用的数据库管理对象
+    :param bool prefiltered: 是否已通过邮件头预筛选, 邮件头获取失败的邮件需完整判断
+    :return: 是否抓取
+    :rtype: bool
+    """
+    outlook = EmailInfoFetch(db_manager=db_manager)
+    outlook.latest_report_time = latest_report_time
+    outlook.email_message = message
+    with db_manager.connection():
+        record = outlook.fetch_email_content(prefiltered=prefiltered)
+        if record is None:
+            return False
+        outlook.save_email(record, writer)
+    return True
+
+
+async def open_session():
+    session = AsyncEmailInfoFetch(use_uid=SYNC_MODE == "uid")
+    await session.login(EMAIL_USERNAME, EMAIL_PASSWORD)
+    await session.inbox()
+    return session
+
+
+async def fetch_worker(session, ids, latest_report_time, executor, writer, db_manager,
+                       max_pending=AIO_MAX_PENDING_SAVES, unverified=()):
+    """
+    单个连接的抓取任务: 下载的邮件交给线程池保存, 等待保存的邮件达到max_pending封时暂停下载,
+    避免数据库或腾讯云慢于网络时整段邮件堆积在内存中; 下载失败时也等待已提交的保存完成后再登出
+
+    :return: 抓取的邮件数量
+    :rtype: int
+    """
+    loop = asyncio.get_running_loop()
+    session.latest_report_time = latest_report_time
+    saving = set()
+    fetched = 0
+    try:
+        async for eid, message in session.iter_emails(ids):
+            if len(saving) >= max_pending:
+                done, saving = await asyncio.wait(saving, return_when=asyncio.FIRST_COMPLETED)
+                fetched += sum(future.result() for future in done)
+            saving.add(loop.run_in_executor(executor, save_message, message, latest_report_time, writer, db_manager,
+                                            eid not in unverified))
+            message = None
+        if saving:
+            fetched += sum(await asyncio.gather(*saving))
+    finally:
+        # 下载异常时不丢下仍在保存的邮件, 保证调用方flush时没有并发的保存
+        if saving:
+            await asyncio.gather(*saving, return_exceptions=True)
+        await session.logout()
+    return fetched
+
+
+async def run_aio_email_fetch(concurrency=FETCH_CONCURRENCY):
+    loop = asyncio.get_running_loop()
+    # 清理上次运行遗留的本地附件
+    attachment_spool.sweep_orphans()
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+    db_manager = DBManagement()
+    sessions = await asyncio.gather(*[open_session() for _ in range(concurrency)])
+    main = sessions[0]
+
+    # 获取待处理邮件并预筛选
+    latest_report_time = await loop.run_in_executor(executor, db_manager.get_latest_report_time)
+    checkpoint = SyncCheckpoint()
+    uid_validity, last_uid = checkpoint.load(main.folder)
+    if main.use_uid and uid_validity is not None and uid_validity == main.uid_validity:
+        # 增量同步以UID范围为准, 不按发件时间过滤(见 EmailInfoFetch.incremental_ids)
+        latest_report_time = None
+        all_ids = await main.all_uids_after(last_uid)
+    else:
+        all_ids = await main.all_ids_since_date(latest_report_time)
+    headers = await main.get_headers(all_ids)
+    prefilter = EmailInfoFetch(use_uid=main.use_uid, db_manager=db_manager)
+    prefilter.latest_report_time = latest_report_time
+    ids = await loop.run_in_executor(executor, prefilter.prefilter_ids, all_ids, headers)
+
+    chunks = split_ids(ids, concurrency)
+    for session in sessions:
+        session.email_sizes = main.email_sizes
+    # 没有分配到邮件的连接直接登出
+    await asyncio.gather(*[session.logout() for session in sessions[len(chunks):]])
+    writer = ReportBatchWriter(db_manager)
+    results = await asyncio.gather(
+        *[fetch_worker(session, chunk, latest_report_time, executor, writer, db_manager,
+                       unverified=prefilter.unverified_ids)
+          for session, chunk in zip(sessions, chunks)],
+        return_exceptions=True
+    )
+    # 各任务已等待自己提交的保存, 关闭线程池后再写入剩余的研报, 保证flush之后不再有add
+    executor.shutdown(wait=True)
+    writer.flush()
+
+    failed = [result for result in results if isinstance(result, Exception)]
+    for err in failed:
+        logger.error(f"抓取任务异常, 错误信息: {err}")
+    if main.use_uid and all_ids and not failed and not writer.failed:
+        checkpoint.save(main.folder, main.uid_validity, max(int(uid) for uid in all_ids))
+    es_tokenizer.log_stats()
+    attachment_index.log_stats()
+    return writer.saved
+
+
+if __name__ == '__main__':
+    start_time = datetime.datetime.now()
+    try:
+        saved = asyncio.run(run_aio_email_fetch())
+    finally:
+        # 等待后台上传完成并关闭上传线程池, 结束附件解析进程
+        cos_uploader.shutdown()
+        extractor_pool.shutdown()
+    end_time = datetime.datetime.now()
+    print("此次邮件异步抓取共保存 {} 封, 共耗时: {}".format(saved, end_time - start_time))
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+# ==============================================================================
+# @ Author :
+# @ Desc : 并发抓取入口(多个IMAP连接并行下载、解析、保存)
+# @ Date : 2021/6/5
+# ==============================================================================
+import datetime
+import math
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from fetch_core.checkpoint import SyncCheckpoint
+from fetch_core.config import EMAIL_USERNAME, EMAIL_PASSWORD, SYNC_MODE, FETCH_CONCURRENCY
+from fetch_core.db import DBManagement, ReportBatchWriter, attachment_index
+from fetch_core.extractor import extractor_pool
+from fetch_core.outlook import EmailInfoFetch
+from fetch_core.spool import attachment_spool
+from fetch_core.tencentyun import cos_uploader
+from utils.es_tokenizer import es_tokenizer
+from utils.init_logger import get_logger
+
+logger = get_logger("concurrent_fetch")
+
+
+def split_ids(ids, parts):
+    """
+    将邮件id列表切分为连续的若干段, 保证每段在FETCH时仍能压缩为区间
+
+    :param list ids: 邮件id列表
+    :param int parts: 段数
+    :return: 切分后的邮件id列表
+    :rtype: list
+    """
+    if not ids:
+        return []
+    size = math.ceil(len(ids) / parts)
+    return [ids[index:index + size] for index in range(0, len(ids), size)]
+
+
+def fetch_worker(worker_id, ids, latest_report_time, writer, db_manager, unverified=()):
+    """
+    单个IMAP连接的抓取任务, 每个任务使用独立的EmailInfoFetch实例
+
+    :param int worker_id: 任务编号
+    :param list ids: 分配给该连接的邮件id
+    :param datetime.datetime latest_report_time: 数据库最新保存研报的发件时间
+    :param writer: 各任务共享的批量写入器
+    :param db_manager: 各任务共享的数据库管理对象
+    :param unverified: 预筛选时未经判断的邮件id, 需完整判断
+    :return: 抓取的邮件数量
+    :rtype: int
+    """
+    outlook = EmailInfoFetch(use_uid=SYNC_MODE == "uid", db_manager=db_manager)
+    outlook.login(EMAIL_USERNAME, EMAIL_PASSWORD)
+    outlook.inbox()
+    outlook.latest_report_time = latest_report_time
+    try:
+        # 线程结束时把连接归还连接池
+        with db_manager.connection():
+            fetched = outlook.fetch_and_save(ids, writer, unverified)
+        logger.info(f"[worker-{worker_id}] 处理邮件 {len(ids)} 封, 抓取 {fetched} 封")
+        return fetched
+    finally:
+        outlook.logout()
+
+
+def run_concurrent_email_fetch(concurrency=FETCH_CONCURRENCY):
+    start_time = datetime.datetime.now()
+    # 清理上次运行遗留的本地附件
+    attachment_spool.sweep_orphans()
+    db_manager = DBManagement()
+    outlook = EmailInfoFetch(use_uid=SYNC_MODE == "uid", db_manager=db_manager)
+    # 主连接只负责获取邮件列表和预筛选
+    outlook.login(EMAIL_USERNAME, EMAIL_PASSWORD)
+    outlook.inbox()
+    checkpoint = SyncCheckpoint()
+    all_ids = outlook.pending_ids(checkpoint)
+    ids = outlook.prefilter_ids(all_ids)
+    latest_report_time, unverified = outlook.latest_report_time, outlook.unverified_ids
+    folder, uid_validity = outlook.folder, outlook.uid_validity
+    outlook.logout()
+
+    chunks = split_ids(ids, concurrency)
+    failed = 0
+    writer = ReportBatchWriter(db_manager)
+    with writer, ThreadPoolExecutor(max_workers=max(len(chunks), 1)) as executor:
+        futures = [executor.submit(fetch_worker, worker_id, chunk, latest_report_time, writer, db_manager, unverified)
+                   for worker_id, chunk in enumerate(chunks)]
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as err:
+                failed += 1
+                logger.error(f"抓取任务异常, 错误信息: {err}")
+
+    # 全部任务成功才推进同步断点, 否则下次运行重新处理
+    if SYNC_MODE == "uid" and all_ids and not failed and not writer.failed:
+        checkpoint.save(folder, uid_validity, max(int(uid) for uid in all_ids))
+
+    es_tokenizer.log_stats()
+    attachment_index.log_stats()
+    end_time = datetime.datetime.now()
+    print("此次邮件并发抓取共保存 {} 封, 共耗时: {}".format(writer.saved, end_time - start_time))
+
+
+if __name__ == '__main__':
+    try:
+        run_concurrent_email_fetch()
+    finally:
+        # 等待后台上传完成并关闭上传线程池, 结束附件解析进程
+        cos_uploader.shutdown()
+        extractor_pool.shutdown()
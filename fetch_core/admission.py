@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+# ==============================================================================
+# @ Author :
+# @ Desc : 附件准入策略(文件类型、单个附件大小、单封邮件附件总大小)
+# @ Date : 2021/6/21
+# ==============================================================================
+from fetch_core.config import ATTACHMENT_ALLOWED_EXTENSIONS, ATTACHMENT_ALLOWED_MIME_TYPES, ATTACHMENT_MAX_SIZE, \
+    ATTACHMENT_MAX_TOTAL
+
+
+class AttachmentPolicy:
+    """ 根据附件名称、类型和大小判断附件是否收录, 不收录的附件不下载、不上传、不解析 """
+
+    def __init__(self, extensions=ATTACHMENT_ALLOWED_EXTENSIONS, mime_types=ATTACHMENT_ALLOWED_MIME_TYPES,
+                 max_size=ATTACHMENT_MAX_SIZE, max_total=ATTACHMENT_MAX_TOTAL):
+        self.extensions = {extension.lower() for extension in extensions}
+        self.mime_types = {mime_type.lower() for mime_type in mime_types}
+        self.max_size = max_size
+        self.max_total = max_total
+
+    def reason(self, name, content_type, size, total=0):
+        """
+        判断附件是否收录
+
+        :param str name: 附件名称
+        :param str content_type: 附件MIME类型, 如 application/pdf
+        :param int size: 附件大小(解码后)
+        :param int total: 本封邮件已收录附件的总大小
+        :return: 不收录的原因, 收录时返回None
+        :rtype: str
+        """
+        extension = name[name.rfind("."):].lower() if "." in name else ""
+        if (self.extensions or self.mime_types) and extension not in self.extensions \
+                and (content_type or "").lower() not in self.mime_types:
+            return "文件类型不在收录范围"
+        if self.max_size and size > self.max_size:
+            return "超过单个附件大小上限{}MB".format(self.max_size // (1024 * 1024))
+        if self.max_total and total + size > self.max_total:
+            return "超过单封邮件附件总大小上限{}MB".format(self.max_total // (1024 * 1024))
+        return None
+
+
+attachment_policy = AttachmentPolicy()
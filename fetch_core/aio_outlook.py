@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+# ==============================================================================
+# @ Author :
+# @ Desc : 基于asyncio的outlook邮件抓取(与EmailInfoFetch接口一致)
+# @ Date : 2021/6/8
+# ==============================================================================
+import asyncio
+import collections
+import email
+import re
+import ssl
+
+from fetch_core.config import EMAIL_HOST, EMAIL_PORT, EMAIL_USERNAME, DES_KEY, PREFILTER_BATCH_SIZE, \
+    FETCH_BATCH_SIZE, FETCH_BATCH_BYTES, AIO_PIPELINE_DEPTH
+from fetch_core.outlook import HEADER_PREFILTER_FIELDS
+from utils.data_processing import get_decrypted_password
+from utils.exceptions import IMAPCommandException
+from utils.imap_utils import parse_fetch_response, compress_id_set, chunk_ids
+from utils.init_logger import get_logger
+
+logger = get_logger("aio_outlook_fetch")
+
+_LITERAL = re.compile(rb"\{(\d+)\}$")
+_UNTAGGED_STATUS = re.compile(rb"^\* (\d+) ([A-Z-]+)(?: (.*))?$", re.S)
+_UNTAGGED = re.compile(rb"^\* ([A-Z-]+)(?: (.*))?$", re.S)
+_UIDVALIDITY = re.compile(rb"\[UIDVALIDITY (\d+)\]")
+
+
+def _quote(value):
+    """ 转为IMAP带引号字符串 """
+    return '"' + value.replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+class AsyncEmailInfoFetch:
+    """
+    单个IMAP连接上的异步抓取
+
+    所有命令都带tag发送, 不等待上一条命令完成即可继续发送(管线化), 由后台读取任务按tag分发响应。
+    无tag响应(FETCH/SEARCH等)归属于最早发出且未完成的命令, 服务端按顺序处理命令时该归属是准确的。
+    """
+
+    def __init__(self, host=EMAIL_HOST, port=EMAIL_PORT, use_ssl=True, use_uid=False):
+        self.host = host
+        self.port = port
+        self.use_ssl = use_ssl
+        self.use_uid = use_uid
+        self.reader = None
+        self.writer = None
+        self.folder = None
+        self.uid_validity = None
+        self.latest_report_time = None  # 数据库最新保存研报的发件时间
+        self.email_sizes = {}
+        self._tag_index = 0
+        self._pending = collections.OrderedDict()  # tag -> (future, {untagged_type: [data, ...]})
+        self._reader_task = None
+
+    async def connect(self):
+        ssl_context = ssl.create_default_context() if self.use_ssl else None
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port, ssl=ssl_context)
+        greeting = await self._read_response()
+        logger.info(f"已连接[{self.host}:{self.port}], {greeting[0]!r}")
+        self._reader_task = asyncio.ensure_future(self._reader_loop())
+
+    async def _read_response(self):
+        """
+        读取一条完整响应(含字面量)
+
+        :return: imaplib 风格的片段列表, 带字面量的片段为 (描述, 内容) 元组
+        :rtype: list
+        """
+        parts = []
+        while True:
+            line = await self.reader.readline()
+            if not line:
+                raise IMAPCommandException("连接已被服务端关闭")
+            line = line.rstrip(b"\r\n")
+            matched = _LITERAL.search(line)
+            if not matched:
+                parts.append(line)
+                return parts
+            literal = await self.reader.readexactly(int(matched.group(1)))
+            parts.append((line, literal))
+
+    def _dispatch_untagged(self, parts):
+        head = parts[0][0] if isinstance(parts[0], tuple) else parts[0]
+        matched = _UNTAGGED_STATUS.match(head)
+        if matched:
+            typ, data = matched.group(2), matched.group(1) + b" " + (matched.group(3) or b"")
+        else:
+            matched = _UNTAGGED.match(head)
+            if not matched:
+                logger.error(f"无法解析的响应: {head!r}")
+                return
+            typ, data = matched.group(1), matched.group(2)
+        if isinstance(parts[0], tuple):
+            parts = [(data, parts[0][1])] + parts[1:]
+        else:
+            parts = [data]
+        if not self._pending:
+            return
+        future, untagged = next(iter(self._pending.values()))
+        untagged.setdefault(typ.decode(), []).extend(parts)
+
+    async def _reader_loop(self):
+        try:
+            while True:
+                parts = await self._read_response()
+                head = parts[0][0] if isinstance(parts[0], tuple) else parts[0]
+                if head.startswith(b"* "):
+                    self._dispatch_untagged(parts)
+                    continue
+                if head.startswith(b"+"):
+                    continue
+                tag, _, rest = head.partition(b" ")
+                status, _, text = rest.partition(b" ")
+                tag = tag.decode()
+                if tag not in self._pending:
+                    logger.error(f"收到未知tag的响应: {head!r}")
+                    continue
+                future, untagged = self._pending.pop(tag)
+                if not future.done():
+                    future.set_result((status.decode(), text, untagged))
+        except (IMAPCommandException, ConnectionError, asyncio.IncompleteReadError) as err:
+            for future, _ in self._pending.values():
+                if not future.done():
+                    future.set_exception(IMAPCommandException(str(err)))
+            self._pending.clear()
+
+    async def _command(self, name, *args):
+        """
+        发送一条带tag的命令并等待其完成; 多个协程可同时调用, 命令会被管线化发送
+
+        :return: (status, 结果文本, {untagged_type: [data, ...]})
+        :rtype: tuple
+        :raises IMAPCommandException: 连接已断开(读取任务已结束), 否则命令的响应永远不会到达
+        """
+        if self._reader_task is None or self._reader_task.done() or self.writer.is_closing():
+            raise IMAPCommandException("连接已断开, 无法发送命令[{}]".format(name))
+        self._tag_index += 1
+        tag = "A{:04d}".format(self._tag_index)
+        future = asyncio.get_running_loop().create_future()
+        self._pending[tag] = (future, {})
+        self.writer.write(" ".join((tag, name) + args).encode() + b"\r\n")
+        await self.writer.drain()
+        return await future
+
+    async def login(self, username, password):
+        await self.connect()
+        decrypted_password = get_decrypted_password(DES_KEY, password)
+        status, text, _ = await self._command("LOGIN", _quote(username), _quote(decrypted_password))
+        if status != "OK":
+            raise IMAPCommandException("登录失败：%s %s" % (status, text))
+        logger.info("=" * 50 + "[{}]已登陆".format(username) + "=" * 50)
+
+    async def logout(self):
+        """ 登出, 连接已断开时只释放连接 """
+        try:
+            await self._command("CLOSE")
+            await self._command("LOGOUT")
+        except (IMAPCommandException, ConnectionError) as err:
+            logger.error(f"登出失败, 错误信息: {err}")
+        if self._reader_task is not None:
+            self._reader_task.cancel()
+        if self.writer is not None:
+            self.writer.close()
+        logger.info("=" * 50 + "[{}]已登出".format(EMAIL_USERNAME) + "=" * 50)
+
+    async def select(self, dir):
+        status, text, untagged = await self._command("SELECT", _quote(dir))
+        if status != "OK":
+            raise IMAPCommandException("选择文件夹[{}]失败: {}".format(dir, text))
+        self.folder = dir
+        self.uid_validity = None
+        for data in untagged.get("OK", []):
+            matched = _UIDVALIDITY.search(data or b"")
+            if matched:
+                self.uid_validity = int(matched.group(1))
+        return status, untagged.get("EXISTS", [])
+
+    async def inbox(self):
+        status, inbox_message = await self.select("INBOX")
+        return inbox_message
+
+    async def _search(self, *criteria):
+        if self.use_uid:
+            status, text, untagged = await self._command("UID", "SEARCH", *criteria)
+        else:
+            status, text, untagged = await self._command("SEARCH", *criteria)
+        if status != "OK":
+            raise IMAPCommandException("SEARCH失败: {}".format(text))
+        return b" ".join(data for data in untagged.get("SEARCH", []) if data).split()
+
+    async def _fetch(self, message_set, message_parts):
+        if self.use_uid:
+            status, text, untagged = await self._command("UID", "FETCH", message_set, message_parts)
+        else:
+            status, text, untagged = await self._command("FETCH", message_set, message_parts)
+        if status != "OK":
+            logger.error(f"FETCH失败, status: {status}, 邮件id: {message_set}, 错误信息: {text!r}")
+        return status, untagged.get("FETCH", [])
+
+    async def all_ids_since_date(self, date_time):
+        self.latest_report_time = date_time
+        date = date_time.strftime("%d-%b-%Y")
+        msg_list = await self._search('(SINCE "' + date + '")', "ALL")
+        logger.info(f"[{str(date_time).split()[0]}] 之后共有邮件数量: {len(msg_list)}")
+        return msg_list
+
+    async def all_uids_after(self, last_uid):
+        status, text, untagged = await self._command("UID", "SEARCH", "UID {}:*".format(last_uid + 1))
+        data = b" ".join(data for data in untagged.get("SEARCH", []) if data)
+        return [uid for uid in data.split() if int(uid) > last_uid]
+
+    def _key(self, item):
+        return str(item["uid"] if self.use_uid else item["seq"])
+
+    async def _pipelined_fetch(self, batches, message_parts, depth=AIO_PIPELINE_DEPTH):
+        """
+        管线化批量FETCH: 同一连接上最多同时有depth条FETCH在途, 按发送顺序逐批返回结果
+
+        :return: 异步生成器, 每批的 (邮件id列表, status, parse_fetch_response 结果)
+        """
+        in_flight = collections.deque()
+        batches = iter(batches)
+        while True:
+            while len(in_flight) < depth:
+                batch = next(batches, None)
+                if batch is None:
+                    break
+                in_flight.append((batch, asyncio.ensure_future(self._fetch(compress_id_set(batch), message_parts))))
+            if not in_flight:
+                return
+            batch, future = in_flight.popleft()
+            status, data = await future
+            yield batch, status, parse_fetch_response(data)
+
+    async def get_headers(self, ids, batch_size=PREFILTER_BATCH_SIZE):
+        """
+        批量获取邮件头和邮件大小
+
+        :return: {id: 仅包含邮件头的message对象}
+        :rtype: dict
+        """
+        headers = {}
+        query = "(RFC822.SIZE BODY.PEEK[HEADER.FIELDS ({})])".format(HEADER_PREFILTER_FIELDS)
+        async for batch, status, items in self._pipelined_fetch(chunk_ids(ids, batch_size), query):
+            for item in items:
+                if item["size"] is not None:
+                    self.email_sizes[self._key(item)] = item["size"]
+                if item["literal"] is not None:
+                    headers[self._key(item)] = email.message_from_bytes(item["literal"])
+        return headers
+
+    async def iter_emails(self, ids, batch_size=FETCH_BATCH_SIZE, byte_budget=FETCH_BATCH_BYTES):
+        """
+        管线化批量下载完整邮件
+
+        :return: 异步生成器, (邮件id, email.message.Message)
+        :raises IMAPCommandException: 有批次下载失败时, 其余批次处理完后抛出, 调用方据此不推进同步断点
+        """
+        batches = chunk_ids(ids, batch_size, byte_budget, self.email_sizes)
+        failed = []
+        async for batch, status, items in self._pipelined_fetch(batches, "(RFC822)"):
+            if status != "OK":
+                failed.extend(batch)
+                continue
+            items.reverse()
+            while items:
+                item = items.pop()
+                if item["literal"] is not None:
+                    yield self._key(item), email.message_from_bytes(item["literal"])
+        if failed:
+            raise IMAPCommandException("批量下载邮件失败 {} 封, 邮件id: {}".format(len(failed), compress_id_set(failed)))
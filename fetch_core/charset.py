@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+# ==============================================================================
+# @ Author :
+# @ Desc : 邮件正文解码(UTF-8和声明的字符集优先, 按发件域名记住声明不符时实际使用的字符集)
+# @ Date : 2021/6/23
+# ==============================================================================
+import codecs
+import threading
+
+from fetch_core.config import BODY_CHARSET_FALLBACKS, ENCODING_GB18030, ENCODING_UTF8
+from utils.init_logger import get_logger
+
+logger = get_logger("charset")
+
+# 常见的声明字符集与实际内容不符: GB2312/GBK 声明的正文经常含有扩展字符, 统一按其超集GB18030解码
+CHARSET_ALIASES = {
+    "gb2312": ENCODING_GB18030,
+    "gbk": ENCODING_GB18030,
+    "cp936": ENCODING_GB18030,
+}
+
+# 声明为这些字符集时先于UTF-8尝试
+WIDE_UNICODE = ("utf-16", "utf-32")
+
+
+class BodyDecoder:
+    """
+    对已解码传输编码(base64/quoted-printable)的正文字节依次尝试:
+    UTF-8 -> 该发件域名声明此字符集时实际使用的字符集 -> 声明的字符集 -> 备选字符集, 同一份字节只解码一次传输编码。
+    UTF-8 校验严格, 非UTF-8字节几乎不会误解码成功, 而 GB18030 等字符集能解码大部分UTF-8字节序列, 因此UTF-8最先尝试(声明为UTF-16/32时除外);
+    某机构声明的字符集解码失败时记住实际使用的字符集, 之后该机构同样声明的邮件直接使用
+    """
+
+    def __init__(self, fallbacks=BODY_CHARSET_FALLBACKS):
+        self.fallbacks = tuple(self.normalize(charset) for charset in fallbacks)
+        self._domains = {}  # (发件域名, 声明的字符集) -> 实际使用的字符集
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def normalize(charset):
+        """ 转换为codecs标准名称, 未知字符集返回None """
+        if not charset:
+            return None
+        try:
+            name = codecs.lookup(charset.strip().strip('"').lower()).name
+        except LookupError:
+            return None
+        return CHARSET_ALIASES.get(name, name)
+
+    def _candidates(self, declared, domain):
+        # UTF-16/32 的ASCII内容也是合法的UTF-8字节(含\x00), 声明为这类字符集时仍以声明为准
+        candidates = [declared, ENCODING_UTF8] if declared and declared.startswith(WIDE_UNICODE) else [ENCODING_UTF8]
+        if domain:
+            with self._lock:
+                candidates.append(self._domains.get((domain, declared)))
+        candidates.append(declared)
+        candidates.extend(self.fallbacks)
+        # 去重并保持顺序
+        return [charset for charset in dict.fromkeys(candidates) if charset]
+
+    def decode(self, payload, declared=None, domain=None):
+        """
+        解码正文字节
+
+        :param bytes payload: message.get_payload(decode=True) 的结果
+        :param str declared: 邮件段声明的字符集, message.get_content_charset()
+        :param str domain: 发件人邮箱域名, 用于记住该机构声明的字符集实际对应的字符集
+        :return: 正文
+        :rtype: str
+        """
+        if not payload:
+            return ""
+        declared = self.normalize(declared)
+        for charset in self._candidates(declared, domain):
+            try:
+                text = payload.decode(charset)
+            except UnicodeDecodeError:
+                continue
+            if domain:
+                self._remember(domain, declared, charset)
+            if declared and charset != declared:
+                logger.info(f"正文声明字符集[{declared}]与内容不符, 使用[{charset}]解码")
+            return text
+        return payload.decode(declared or ENCODING_UTF8, errors="replace")
+
+    def _remember(self, domain, declared, charset):
+        """
+        记住声明的字符集解码失败时实际使用的字符集。
+        UTF-8 总是最先尝试, 最后的备选字符集能解码任意字节只作兜底, 二者都不记忆; 声明的字符集恢复可用时忘记
+        """
+        key = (domain, declared)
+        with self._lock:
+            if charset == declared:
+                self._domains.pop(key, None)
+            elif charset != ENCODING_UTF8 and charset not in self.fallbacks[-1:]:
+                self._domains[key] = charset
+
+
+body_decoder = BodyDecoder()
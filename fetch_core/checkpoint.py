@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+# ==============================================================================
+# @ Author :
+# @ Desc : UID增量同步断点
+# @ Date : 2021/6/3
+# ==============================================================================
+import json
+import os
+import threading
+
+from fetch_core.config import SYNC_CHECKPOINT_PATH
+from utils.init_logger import get_logger
+
+logger = get_logger("checkpoint")
+
+
+class SyncCheckpoint:
+    """ 按文件夹保存 (UIDVALIDITY, 最后处理的UID) """
+
+    def __init__(self, path=SYNC_CHECKPOINT_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def _read(self):
+        if not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError) as err:
+            logger.error(f"读取同步断点文件[{self.path}]失败, 将按日期全量扫描, 错误信息: {err}")
+            return {}
+
+    def load(self, folder):
+        """
+        读取文件夹的同步断点
+
+        :param str folder: 邮箱文件夹
+        :return: (uid_validity, last_uid), 没有断点时返回 (None, 0)
+        :rtype: tuple
+        """
+        with self._lock:
+            point = self._read().get(folder)
+        if not point:
+            return None, 0
+        return point["uid_validity"], point["last_uid"]
+
+    def save(self, folder, uid_validity, last_uid):
+        """
+        保存文件夹的同步断点(先写临时文件再替换, 避免中途退出损坏断点文件)
+
+        :param str folder: 邮箱文件夹
+        :param int uid_validity: 文件夹的UIDVALIDITY
+        :param int last_uid: 最后处理的UID
+        :return:
+        """
+        with self._lock:
+            points = self._read()
+            points[folder] = {"uid_validity": uid_validity, "last_uid": last_uid}
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(points, f)
+            os.replace(tmp_path, self.path)
+        logger.info(f"同步断点已保存, 文件夹: {folder}, UIDVALIDITY: {uid_validity}, UID: {last_uid}")
@@ -15,6 +15,36 @@ EMAIL_PORT = 993
 EMAIL_USERNAME = ""
 EMAIL_PASSWORD = ""
 DES_KEY = ""
+# 邮件头预筛选时单次FETCH的邮件数量
+PREFILTER_BATCH_SIZE = 500
+# 批量下载完整邮件时单次FETCH的邮件数量和字节上限
+FETCH_BATCH_SIZE = 50
+FETCH_BATCH_BYTES = 20 * 1024 * 1024
+# 邮件下载方式: "rfc822" 下载完整邮件; "bodystructure" 先获取邮件结构, 只下载正文和带名称的附件部分
+FETCH_MODE = "bodystructure"
+# 流水线抓取(run.py)各阶段的工作线程数: 下载(每个线程一个IMAP连接)、解析邮件、解析附件、上传附件、保存数据库
+PIPELINE_WORKERS = {
+    "fetch": 1,
+    "parse": 2,
+    "extract": 2,
+    "upload": 4,
+    "db": 1,
+}
+# 流水线各阶段输入队列的长度(队列满时上一阶段等待), 输出各阶段队列深度的间隔(秒)
+PIPELINE_QUEUE_SIZE = 16
+PIPELINE_REPORT_INTERVAL = 30
+# 流水线各阶段输入队列中邮件内容、附件内容占用内存的上限(字节), 超过 ATTACHMENT_SPILL_THRESHOLD 的附件写入本地附件目录后只传递路径
+PIPELINE_QUEUE_BYTES = 256 * 1024 * 1024
+# 并发抓取(concurrent_run.py)的IMAP连接数量
+FETCH_CONCURRENCY = 4
+# asyncio抓取(aio_run.py)单个连接上同时在途的FETCH命令数量
+AIO_PIPELINE_DEPTH = 4
+# asyncio抓取单个连接已下载、等待保存的邮件数量上限, 达到上限后暂停下载(背压)
+AIO_MAX_PENDING_SAVES = 8
+# 同步模式: "uid" 基于UID增量同步(UIDVALIDITY变化时退回按日期扫描), "date" 每次按日期扫描
+SYNC_MODE = "uid"
+# UID同步断点文件
+SYNC_CHECKPOINT_PATH = os.path.join(BASE_DIR, "sync_checkpoint.json")
 
 
 # 腾讯云用户属性配置
@@ -26,6 +56,9 @@ TENCENTCLOUD_CONFIG = {
     "APPID": "",
     "TOKEN": None,
 }
+# 附件后台上传的线程数, 排队中的上传数量上限(达到上限时等待)
+COS_UPLOAD_WORKERS = 4
+COS_UPLOAD_QUEUE_SIZE = 16
 
 # MySQL数据库配置（demo阶段测试用）
 MySQL_CONFIG = {
@@ -33,16 +66,74 @@ MySQL_CONFIG = {
     "port": 4000,
     "user": "",
     "password": "",
-    "db_name": ""
+    "db_name": "",
+    # 连接池: 最大连接数、空闲连接回收时间(秒, 需小于MySQL的wait_timeout)、等待空闲连接的超时时间(秒)
+    "max_connections": 8,
+    "stale_timeout": 300,
+    "timeout": 10
 }
 
+# 外部研报机构(邮箱后缀白名单)缓存刷新间隔, 单位秒
+AUTHOR_CACHE_TTL = 600
+
+# 研报标题去重索引预加载的时间范围, 单位天
+SUBJECT_INDEX_WINDOW_DAYS = 30
+
+# 标题匹配股票标签的方式: "local" 本地多模式匹配t_tag股票名称, "es" 调用ES拆词接口后逐词查询
+TAG_MATCHER = "local"
+# 本地股票标签匹配器重新读取t_tag的间隔(内容有变化时才重新构建), 单位秒
+TAG_CACHE_TTL = 1800
+
+# 批量写入MySQL时每个事务保存的研报数量
+DB_BATCH_SIZE = 20
+# 按内容哈希去重的附件, 进程内缓存解析结果的附件数量
+ATTACHMENT_TEXT_CACHE_SIZE = 256
+
 # ES拆词接口
 ES_URL = "http://ip:port/es/analyzerReturnList?"
+# ES拆词接口连接池大小、连接/读取超时(秒)、拆词结果缓存条数
+ES_POOL_SIZE = 8
+ES_CONNECT_TIMEOUT = 3
+ES_READ_TIMEOUT = 10
+ES_CACHE_SIZE = 4096
 
 # 本地附件存储路径
 LOCAL_ATTACHMENT_ABSPATH = os.path.join(BASE_DIR, "attachments") + os.sep
+# 附件是否在内存中直接上传和解析(不落盘), 超过落盘阈值(字节)的大附件仍先写入本地
+ATTACHMENT_IN_MEMORY = True
+ATTACHMENT_SPILL_THRESHOLD = 50 * 1024 * 1024
+# 本地附件目录的磁盘配额(字节), 超过时等待其它附件删除, 最多等待秒数
+ATTACHMENT_SPOOL_QUOTA = 2 * 1024 * 1024 * 1024
+ATTACHMENT_SPOOL_WAIT = 600
+# 启动时清理本地附件目录中超过该时间(秒)的遗留文件
+ATTACHMENT_ORPHAN_AGE = 3600
+# 附件准入策略: 收录的文件类型(后缀或MIME类型满足其一即可, 都为空时不限制),
+# 单个附件大小上限、单封邮件附件总大小上限(字节, 为0时不限制)
+ATTACHMENT_ALLOWED_EXTENSIONS = (".pdf", ".xlsx", ".xls", ".doc", ".docx", ".ppt", ".pptx")
+ATTACHMENT_ALLOWED_MIME_TYPES = (
+    "application/pdf",
+    "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+)
+ATTACHMENT_MAX_SIZE = 100 * 1024 * 1024
+ATTACHMENT_MAX_TOTAL = 200 * 1024 * 1024
+# pdf附件最多提取文字的页数、最多保留的文字数量(为0时不限制), 是否进行版面分析。
+# 关闭时与原先 extract_text_to_fp(未传laparams) 的输出格式一致; 开启后按版面分段, attachment_text 中每页末尾会多出空行
+PDF_MAX_PAGES = 100
+PDF_MAX_CHARS = 100000
+PDF_LAYOUT_ANALYSIS = False
+# xlsx附件最多读取的行数(所有工作表合计)、最多保留的文字数量, 为0时不限制
+EXCEL_MAX_ROWS = 20000
+EXCEL_MAX_CHARS = 100000
+# 附件解析进程池: 进程数(为0时在抓取线程中直接解析), 单个附件解析超时(秒),
+# 单个解析进程的内存上限(字节, 为0时不限制), 每个进程解析多少个附件后重启
+EXTRACT_WORKERS = 2
+EXTRACT_TIMEOUT = 120
+EXTRACT_MEMORY_LIMIT = 1024 * 1024 * 1024
+EXTRACT_MAX_TASKS_PER_WORKER = 50
 
 # 加密
 ENCODING_GB18030 = "gb18030"
 ENCODING_UTF8 = "utf-8"
 ENCODING_ISO_8859_1 = "iso-8859-1"
+# 邮件正文解码: 声明的字符集失败后依次尝试的字符集, 最后一个应能解码任意字节
+BODY_CHARSET_FALLBACKS = (ENCODING_UTF8, ENCODING_GB18030, ENCODING_ISO_8859_1)
@@ -4,28 +4,44 @@
 # @ Desc : MySQL数据库相关函数
 # @ Date : 2021/5/13
 # ==============================================================================
-import random
+import datetime
+import hashlib
+import threading
 import time
+from collections import OrderedDict
+from concurrent.futures import Future
 
 # 第三方库
-from peewee import MySQLDatabase, Model, AutoField, CharField, IntegerField, SmallIntegerField, \
-    TextField, DateTimeField, BigIntegerField, DoesNotExist
+from peewee import Model, AutoField, CharField, IntegerField, SmallIntegerField, \
+    TextField, DateTimeField, BigIntegerField, DoesNotExist, Case
+from playhouse.pool import PooledMySQLDatabase
+from playhouse.shortcuts import ReconnectMixin
 # 项目内部库
-from fetch_core.config import MySQL_CONFIG
+from fetch_core.config import MySQL_CONFIG, AUTHOR_CACHE_TTL, SUBJECT_INDEX_WINDOW_DAYS, TAG_MATCHER, TAG_CACHE_TTL, \
+    DB_BATCH_SIZE, ATTACHMENT_TEXT_CACHE_SIZE
+from utils.ac_automaton import ACAutomaton
+from utils.exceptions import Save2DBException
 from utils.init_logger import get_logger
-from utils.data_processing import get_es_words_from_subject, get_uuid4, remove_html_tag
+from utils.data_processing import get_es_words_from_subject, get_report_key, remove_html_tag
 
 logger = get_logger("database")
 
 
+class ReconnectPooledMySQLDatabase(ReconnectMixin, PooledMySQLDatabase):
+    """ 带连接池的MySQL数据库, 连接被服务端断开(如超过wait_timeout)时自动重连 """
+
+
 def gen_mysql():
-    """ 生成数据库连接对象 """
-    db = MySQLDatabase(
+    """ 生成数据库连接对象(连接池, 每个线程独立检出连接) """
+    db = ReconnectPooledMySQLDatabase(
         host=MySQL_CONFIG["host"],
         port=MySQL_CONFIG["port"],
         user=MySQL_CONFIG["user"],
         password=MySQL_CONFIG["password"],
-        database=MySQL_CONFIG["db_name"]
+        database=MySQL_CONFIG["db_name"],
+        max_connections=MySQL_CONFIG["max_connections"],
+        stale_timeout=MySQL_CONFIG["stale_timeout"],
+        timeout=MySQL_CONFIG["timeout"]
     )
     return db
 
@@ -137,12 +153,260 @@ class TReportOtherUser(BaseModel):
 ########################################################################################################################
 
 
+class AuthorCache:
+    """ 邮箱后缀 -> 机构名 的进程内缓存(整表加载, 按TTL刷新; 未命中同样会被缓存到下次刷新) """
+
+    def __init__(self, ttl=AUTHOR_CACHE_TTL):
+        self.ttl = ttl
+        self._authors = None
+        self._loaded_at = 0
+        self._lock = threading.Lock()
+
+    def _load(self):
+        authors = {}
+        query = TReportOtherUser.select(TReportOtherUser.suffix, TReportOtherUser.author).order_by(TReportOtherUser.id)
+        for row in query:
+            # 后缀重复时与 TReportOtherUser.get(suffix=...) 一致, 取第一条
+            authors.setdefault(row.suffix, row.author)
+        self._authors = authors
+        self._loaded_at = time.monotonic()
+        logger.info("外部研报机构表已加载至缓存, 共 {} 个邮箱后缀".format(len(authors)))
+
+    def get(self, suffix):
+        """
+        获取邮箱后缀对应的机构名
+
+        :param str suffix: 邮箱后缀, 如 "@example.com"
+        :return: 机构名, 不在白名单返回None
+        """
+        with self._lock:
+            if self._authors is None or time.monotonic() - self._loaded_at > self.ttl:
+                self._load()
+            return self._authors.get(suffix)
+
+    def invalidate(self):
+        """ 使缓存失效, 下次查询时重新加载 """
+        with self._lock:
+            self._authors = None
+
+
+author_cache = AuthorCache()
+
+
+class SubjectIndex:
+    """ 研报标题去重索引: 一次查询预加载时间范围内的标题摘要, 之后的判断均在内存中完成 """
+
+    def __init__(self, window_days=SUBJECT_INDEX_WINDOW_DAYS):
+        self.window_days = window_days
+        self._digests = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _digest(subject):
+        return hashlib.md5(subject.encode("utf-8")).digest()
+
+    def _ensure_loaded(self):
+        if self._digests is not None:
+            return
+        since = datetime.datetime.now() - datetime.timedelta(days=self.window_days)
+        query = TReport.select(TReport.name).where(TReport.send_time >= since).tuples()
+        self._digests = {self._digest(name) for name, in query}
+        logger.info("研报标题索引已加载, 最近{}天共 {} 个标题".format(self.window_days, len(self._digests)))
+
+    def contains(self, subject):
+        """ 判断标题是否已存在 """
+        with self._lock:
+            self._ensure_loaded()
+            return self._digest(subject) in self._digests
+
+    def claim(self, subject):
+        """
+        占用标题: 标题不存在时加入索引并返回True, 已存在返回False。
+        检查与写入在同一把锁内完成, 并发保存同名研报时只有一个能占用成功
+
+        :param str subject: 研报标题
+        :rtype: bool
+        """
+        with self._lock:
+            self._ensure_loaded()
+            digest = self._digest(subject)
+            if digest in self._digests:
+                return False
+            self._digests.add(digest)
+            return True
+
+    def release(self, subject):
+        """ 保存失败时释放已占用的标题 """
+        with self._lock:
+            if self._digests is not None:
+                self._digests.discard(self._digest(subject))
+
+
+subject_index = SubjectIndex()
+
+
+class StockTagger:
+    """ 本地股票标签匹配: t_tag 的股票名称一次性加载为 Aho-Corasick 自动机, 标题单次线性扫描即可得到tag_id """
+
+    def __init__(self, ttl=TAG_CACHE_TTL):
+        self.ttl = ttl
+        self._automaton = None
+        self._version = None
+        self._checked_at = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _table_rows():
+        return list(TTag.select(TTag.id, TTag.stock_name).order_by(TTag.id).tuples())
+
+    @staticmethod
+    def _table_version(rows):
+        """ t_tag 的版本: (id, 股票名称) 的摘要, 新增、删除和修改名称都会使摘要变化 """
+        return hashlib.md5(repr(rows).encode("utf-8")).digest()
+
+    def _load(self, rows, version):
+        automaton = ACAutomaton()
+        for tag_id, stock_name in rows:
+            # 股票名称重复时与 TTag.get(stock_name=...) 一致, 取第一条
+            automaton.add(stock_name, tag_id)
+        automaton.build()
+        self._automaton = automaton
+        self._version = version
+        logger.info("股票标签匹配器已构建, 共 {} 个股票名称".format(len(automaton)))
+
+    def _refresh(self):
+        """ 按TTL重新读取 t_tag, 内容有变化时才重新构建自动机 """
+        now = time.monotonic()
+        if self._automaton is not None and now - self._checked_at <= self.ttl:
+            return
+        rows = self._table_rows()
+        version = self._table_version(rows)
+        if self._automaton is None or version != self._version:
+            self._load(rows, version)
+        self._checked_at = now
+
+    def match(self, text):
+        """
+        匹配文本中的股票名称
+
+        :param str text: 邮件标题
+        :return: tag_id列表(按出现顺序去重)
+        :rtype: list
+        """
+        with self._lock:
+            self._refresh()
+            automaton = self._automaton
+        tag_id_list = []
+        for start, end, tag_id in automaton.find_longest(text):
+            if tag_id not in tag_id_list:
+                tag_id_list.append(tag_id)
+        return tag_id_list
+
+
+stock_tagger = StockTagger()
+
+
+class AttachmentIndex:
+    """
+    附件内容哈希索引: 附件键由内容哈希生成, 已上传过的附件不再重复上传, 解析结果在进程内缓存。
+    占用附件键的调用方负责上传并调用 finish, 上传完成前其它相同内容的附件拿到该上传的Future, 上传失败时一并不收录
+    """
+
+    def __init__(self, text_cache_size=ATTACHMENT_TEXT_CACHE_SIZE):
+        self.text_cache_size = text_cache_size
+        self._known = {}  # 附件键 -> 上传中的Future, 已上传或已存在于附件表时为None
+        self._texts = OrderedDict()  # 附件键 -> (页数, 文字内容)
+        self._lock = threading.Lock()
+        # 统计
+        self.hits = 0
+        self.saved_bytes = 0
+
+    def claim(self, uuid, size):
+        """
+        占用附件键: 附件未上传过时由调用方上传(之后必须调用 finish);
+        已在本进程上传、正在上传或已存在于附件表时不需要上传
+
+        :param str uuid: 附件键(内容哈希+文件类型)
+        :param int size: 附件大小, 用于统计节省的上传字节数
+        :return: (是否由调用方上传, 正在进行的上传Future(上传完成或不需要等待时为None))
+        :rtype: tuple
+        """
+        existed = None
+        while True:
+            with self._lock:
+                if uuid not in self._known and existed is not None:
+                    if not existed:
+                        self._known[uuid] = Future()
+                        return True, None
+                    self._known[uuid] = None
+                if uuid in self._known:
+                    self.hits += 1
+                    self.saved_bytes += size
+                    return False, self._known[uuid]
+            # 查询附件表时不占用锁, 其它线程的附件判断不必等待这次数据库往返
+            existed = TAttachment.select().where(TAttachment.uuid == uuid).exists()
+
+    def finish(self, uuid, error=None):
+        """
+        占用附件键的调用方上传结束: 成功时标记为已上传; 失败时释放附件键, 之后相同内容的附件重新上传。
+        重复调用时只有第一次生效
+
+        :param str uuid: 附件键
+        :param error: 上传失败的异常, 成功时为None
+        """
+        with self._lock:
+            future = self._known.get(uuid)
+            if future is None or future.done():
+                return
+            if error is None:
+                self._known[uuid] = None
+            else:
+                del self._known[uuid]
+        if error is None:
+            future.set_result(None)
+        else:
+            future.set_exception(error)
+
+    def get_text(self, uuid):
+        """
+        :return: 缓存的(页数, 文字内容), 未缓存返回None
+        :rtype: tuple
+        """
+        with self._lock:
+            result = self._texts.get(uuid)
+            if result is not None:
+                self._texts.move_to_end(uuid)
+            return result
+
+    def set_text(self, uuid, page, text):
+        with self._lock:
+            self._texts[uuid] = (page, text)
+            if len(self._texts) > self.text_cache_size:
+                self._texts.popitem(last=False)
+
+    def log_stats(self):
+        if self.hits:
+            logger.info("附件去重统计: 重复附件 {} 个, 节省上传 {} 字节".format(self.hits, self.saved_bytes))
+
+
+attachment_index = AttachmentIndex()
+
+
 class DBManagement:
-    """ 数据库管理(通过模型类保存数据至相关数据库表)"""
+    """ 数据库管理(通过模型类保存数据至相关数据库表), 无状态, 整个抓取过程共用一个实例 """
 
     def __init__(self):
         self.author = ""  # 机构名
 
+    @staticmethod
+    def connection():
+        """
+        当前线程检出一个连接池连接, 退出时归还, 用于抓取线程中包裹一段数据库操作
+
+        :return: 上下文管理器
+        """
+        return db_mysql.connection_context()
+
     def _save_t_attachment(self, attachment_list):
         """
         保存附件信息至MySQL
@@ -151,24 +415,32 @@ class DBManagement:
         :return: attach_uuid_list
         :rtype: list
         """
-        attach_uuid_list = []
-
-        for uuid, name, size in attachment_list:
-            # 先查询该附件是否保存过
-            count = TAttachment.filter(uuid=uuid).count()
-            if count != 0:
-                attach_uuid_list.append(uuid)
-                continue
-            attach = TAttachment(
-                uuid=uuid,
-                name=name,
-                size=size
-            )
-            attach.save()
-            attach_uuid_list.append(uuid)
+        attach_uuid_list = [uuid for uuid, name, size in attachment_list]
+        self._insert_missing_attachments(attachment_list)
         logger.info("附件信息保存成功, uuid_list: {}".format(attach_uuid_list))
         return attach_uuid_list
 
+    @staticmethod
+    def _insert_missing_attachments(attachment_list):
+        """
+        一次 WHERE uuid IN (...) 查询出已保存过的附件, 其余附件一次多行插入
+
+        :param list attachment_list: 附件信息, 数据结构: [(attach_uuid, attach_name, attach_size), ...]
+        :return: 新增附件数量
+        :rtype: int
+        """
+        if not attachment_list:
+            return 0
+        uuids = list({uuid for uuid, name, size in attachment_list})
+        existed = {uuid for uuid, in TAttachment.select(TAttachment.uuid).where(TAttachment.uuid.in_(uuids)).tuples()}
+        rows = {}
+        for uuid, name, size in attachment_list:
+            if uuid not in existed and uuid not in rows:
+                rows[uuid] = {"uuid": uuid, "name": name, "size": size}
+        if rows:
+            TAttachment.insert_many(list(rows.values())).execute()
+        return len(rows)
+
     def _save_t_report_content(self, body):
         """
         保存邮件正文信息至MySQL
@@ -198,6 +470,9 @@ class DBManagement:
         :return: [{"id": id, "type": type, "type_id": type_id}, ...]
         :rtype: list
         """
+        if TAG_MATCHER == "local":
+            return stock_tagger.match(subject)
+
         t_tag_id_list = []
 
         # es拆词拿到词组
@@ -220,29 +495,21 @@ class DBManagement:
         index = sender.rfind("@")
         suffix = sender[index:]
 
-        # 通过发件人邮箱后缀查外部研报机构表获得
-        try:
-            author = TReportOtherUser.get(suffix=suffix)
-        except DoesNotExist:
-            author = None
+        # 通过发件人邮箱后缀查外部研报机构表(进程内缓存)获得
+        author = author_cache.get(suffix)
 
         if not author:  # 如果没查到，邮件跳过不处理
             logger.info("发件人邮箱 [{}] 未在白名单邮箱中，不作处理。".format(sender))
             # 没有通过邮箱后缀查找到机构名，直接返回 0
             return None
 
-        logger.info("邮箱后缀: [{}] 对应的研报机构名为: [{}]".format(suffix, author.author))
-        return author.author
-
-    def _save_t_report(self, data: dict):
-        """
-        保存邮件信息至研报表
-
-        :param data:
-        :return: report.id
-        """
+        logger.info("邮箱后缀: [{}] 对应的研报机构名为: [{}]".format(suffix, author))
+        return author
 
-        report = TReport(
+    @staticmethod
+    def _report_row(data: dict):
+        """ 邮件信息转为研报表的一行数据 """
+        return dict(
             uuid=data["uuid"],
             name=data["subject"],
             type=data["type"],
@@ -264,8 +531,21 @@ class DBManagement:
             send_time=data["datetime"],
             from_email=data["sender"]
         )
-        report.save()
-        report_id = report.id
+
+    def _save_t_report(self, data: dict):
+        """
+        保存邮件信息至研报表(研报唯一键uuid重复时忽略插入)
+
+        :param data:
+        :return: report.id, 研报已存在时返回None
+        """
+
+        # 忽略插入时以影响行数判断, 不依赖各数据库对 lastrowid 的不同处理
+        cursor = TReport._meta.database.execute(TReport.insert(**self._report_row(data)).on_conflict_ignore())
+        report_id = cursor.lastrowid if cursor.rowcount else None
+        if not report_id:
+            logger.info("研报唯一键[{}]已存在, 忽略插入".format(data["uuid"]))
+            return None
         logger.info("研报表保存成功, report_id: {}".format(report_id))
         return report_id
 
@@ -274,31 +554,18 @@ class DBManagement:
         保存邮件至MySQL
 
         :param dict data: 邮件内容
-        :return:
+        :return: 保存成功返回True, 标题重复或研报已存在返回False
+        :rtype: bool
+        :raises Save2DBException: 保存异常(已回滚并释放标题)
         """
-        # 判断研报标题是否重名，重名则跳过保存。此处再判断一次，担心多线程引起的重复保存
-        if self.if_report_name_repeat(data["subject"]):
-            return
-
-        # 补充t_report表中其它非必填数据
-        data["stock_id"] = 0
-        data["is_delete"] = 0
-        data["associated_id"] = 0
-        data["category_id"] = 0
-        data["author_id"] = 0
-        data["status"] = 2
-        data["type"] = 5
-        data["description"] = remove_html_tag(data["body"])
-        data["summary"] = ""
-
-        # 创建uuid
-        data["uuid"] = get_uuid4()
-        # 获取 tag_id_list
-        subject = data["subject"].replace(data["author"], "")  # 标题剔除本地机构名
-        data["tag_id_list"] = self._get_tag_id(subject=subject)
+        # 判断研报标题是否重名，重名则跳过保存。此处再判断一次并占用标题，避免多线程引起的重复保存
+        if not subject_index.claim(data["subject"]):
+            logger.info("研报表标题[{}]重复，跳过保存".format(data["subject"]))
+            return False
 
         try:
-            with db_mysql.atomic():
+            self._prepare_report_data(data)
+            with db_mysql.atomic() as transaction:
                 # 保存邮件正文至t_report_content
                 content_id = self._save_t_report_content(data["body"])
                 data["content_id"] = content_id
@@ -307,14 +574,130 @@ class DBManagement:
                 data["attachment_list"] = self._save_t_attachment(data["attachment_list"])
 
                 report_id = self._save_t_report(data)
+                if report_id is None:
+                    # 其它抓取进程已保存该邮件, 回滚本次写入的正文和附件
+                    transaction.rollback()
+                    return False
 
                 self._save_back_report_id(content_id, report_id)
                 logger.info("""
 ================================邮件内容已成功保存至MySQL================================
                             """)
         except Exception as err:
+            subject_index.release(data["subject"])
             logger.error(f"[{data['subject']}]保存至数据库异常，异常信息: {err}")
+            raise Save2DBException(repr(err))
+        return True
 
+    def _prepare_report_data(self, data):
+        """ 补充研报表的非必填数据、研报唯一键和标签 """
+        # 补充t_report表中其它非必填数据
+        data["stock_id"] = 0
+        data["is_delete"] = 0
+        data["associated_id"] = 0
+        data["category_id"] = 0
+        data["author_id"] = 0
+        data["status"] = 2
+        data["type"] = 5
+        data["description"] = remove_html_tag(data["body"])
+        # 未收录的附件及原因记录在摘要中
+        summary = ""
+        skipped = data.get("skipped_attachments")
+        if skipped:
+            summary = "未收录附件: " + "; ".join("{}({})".format(name, reason) for name, reason in skipped)
+        data["summary"] = summary[:255]
+
+        # 研报唯一键: 由 Message-ID(缺失时为内容哈希)生成, 同一封邮件多次保存时依赖唯一索引去重
+        data["uuid"] = get_report_key(
+            data.get("message_id"), data["subject"], data["sender"], data["datetime"], data["body"]
+        )
+        # 获取 tag_id_list
+        subject = data["subject"].replace(data["author"], "")  # 标题剔除本地机构名
+        data["tag_id_list"] = self._get_tag_id(subject=subject)
+        data["content_id"] = 0
+
+    def _save_t_attachment_many(self, data_list):
+        """
+        批量保存多封邮件的附件信息, 未保存过的附件一次性插入
+
+        :param list data_list: 邮件内容列表, 每封邮件的 attachment_list 更新为 attach_uuid_list
+        :return:
+        """
+        attachment_list = [attach for data in data_list for attach in data["attachment_list"]]
+        for data in data_list:
+            data["attachment_list"] = [uuid for uuid, name, size in data["attachment_list"]]
+        inserted = self._insert_missing_attachments(attachment_list)
+        logger.info("附件信息批量保存成功, 新增附件数量: {}".format(inserted))
+
+    def save_emails_to_mysql(self, data_list):
+        """
+        在一个事务中批量保存多封邮件
+
+        保存顺序: 附件 -> 研报(content_id暂为0, 唯一键重复时忽略) -> 按uuid取回研报id ->
+        正文(直接带上report_id) -> 按report_id取回正文id -> 一条 UPDATE ... CASE 回填所有研报的content_id。
+        同一批中研报唯一键(uuid)相同的邮件(同一封邮件投递到多个别名)只保存第一封
+
+        :param list data_list: 邮件内容列表
+        :return: 保存的研报数量
+        :rtype: int
+        :raises Save2DBException: 保存异常(整批回滚并释放标题)
+        """
+        prepared = []
+        uuids = set()
+        try:
+            for data in data_list:
+                # 判断研报标题是否重名并占用标题
+                if not subject_index.claim(data["subject"]):
+                    logger.info("研报表标题[{}]重复，跳过保存".format(data["subject"]))
+                    continue
+                prepared.append(data)
+                self._prepare_report_data(data)
+                if data["uuid"] in uuids:
+                    # 唯一键冲突时 INSERT IGNORE 只插入一行, 重复的邮件不能再写入正文和附件
+                    prepared.pop()
+                    subject_index.release(data["subject"])
+                    logger.info("研报[{}]与同批邮件唯一键重复，跳过保存".format(data["subject"]))
+                    continue
+                uuids.add(data["uuid"])
+            if not prepared:
+                return 0
+
+            with db_mysql.atomic():
+                self._save_t_attachment_many(prepared)
+
+                TReport.insert_many([self._report_row(data) for data in prepared]).on_conflict_ignore().execute()
+                # content_id 不为0的是其它抓取进程已保存的研报
+                query = TReport.select(TReport.id, TReport.uuid, TReport.content_id) \
+                    .where(TReport.uuid.in_(list(uuids))).tuples()
+                rows = {uuid: (report_id, content_id) for report_id, uuid, content_id in query}
+                report_ids = {uuid: report_id for uuid, (report_id, content_id) in rows.items() if not content_id}
+                # INSERT IGNORE 把行错误当作唯一键重复忽略, 插入失败的研报在数据库中查不到
+                missing = [data for data in prepared if data["uuid"] not in rows]
+                if missing:
+                    for data in missing:
+                        subject_index.release(data["subject"])
+                    logger.error("批量保存研报时 {} 篇插入被忽略, uuid: {}".format(
+                        len(missing), [data["uuid"] for data in missing]))
+                saved = [data for data in prepared if data["uuid"] in report_ids]
+                if not saved:
+                    return 0
+
+                TReportContent.insert_many(
+                    [{"report_id": report_ids[data["uuid"]], "content": data["body"]} for data in saved]
+                ).execute()
+                query = TReportContent.select(TReportContent.id, TReportContent.report_id) \
+                    .where(TReportContent.report_id.in_(list(report_ids.values()))).tuples()
+                content_ids = {report_id: content_id for content_id, report_id in query}
+
+                TReport.update(content_id=Case(TReport.id, list(content_ids.items()))) \
+                    .where(TReport.id.in_(list(content_ids))).execute()
+            logger.info("批量保存研报成功, 共 {} 篇, report_id: {}".format(len(saved), list(report_ids.values())))
+            return len(saved)
+        except Exception as err:
+            for data in prepared:
+                subject_index.release(data["subject"])
+            logger.error(f"批量保存{len(prepared)}篇研报至数据库异常，异常信息: {err}")
+            raise Save2DBException(repr(err))
 
     def get_latest_report_time(self):
         """ 获取研报表最新一条记录的邮件发送时间 """
@@ -328,12 +711,66 @@ class DBManagement:
 
     def if_report_name_repeat(self, subject):
         """ 检查是否名称重复 """
-        time.sleep(random.randint(1, 4))
-        count = TReport.filter(name=subject).count()
-        # print(f"[{subject}] 标题在研报表中的数量: {count}")
-        if count != 0:
+        if subject_index.contains(subject):
             logger.info("研报表标题[{}]重复，跳过保存".format(subject))
             return True
 
         else:
             return False
+
+
+class ReportBatchWriter:
+    """
+    累积解析完成的邮件, 每满batch_size封在一个事务中批量写入(线程安全, 可在多个抓取线程间共享);
+    批量写入失败时逐封重试, 仍失败的邮件数记入 failed, 调用方据此不推进同步断点
+    """
+
+    def __init__(self, db_manager=None, batch_size=DB_BATCH_SIZE):
+        self.db_manager = db_manager or DBManagement()
+        self.batch_size = batch_size
+        self.saved = 0
+        self.failed = 0
+        self._buffer = []
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.flush()
+
+    def add(self, data):
+        """
+        添加一封邮件, 缓冲区满时写入数据库
+
+        :param dict data: 邮件内容
+        """
+        with self._lock:
+            self._buffer.append(data)
+            if len(self._buffer) < self.batch_size:
+                return
+            batch, self._buffer = self._buffer, []
+        self._write(batch)
+
+    def flush(self):
+        """ 写入缓冲区中剩余的邮件 """
+        with self._lock:
+            batch, self._buffer = self._buffer, []
+        if batch:
+            self._write(batch)
+
+    def _write(self, batch):
+        saved = failed = 0
+        try:
+            # 批量保存会改写邮件内容(如 attachment_list), 传入副本, 失败时用原数据逐封重试
+            saved = self.db_manager.save_emails_to_mysql([dict(data) for data in batch])
+        except Save2DBException:
+            logger.info(f"批量保存失败, 逐封重试 {len(batch)} 封")
+            for data in batch:
+                try:
+                    saved += self.db_manager.save_email_to_mysql(data)
+                except Save2DBException:
+                    failed += 1
+        with self._lock:
+            self.saved += saved
+            self.failed += failed
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+# ==============================================================================
+# @ Author :
+# @ Desc : 附件解析进程池(超时、内存上限、按处理数量重启进程)
+# @ Date : 2021/6/18
+# ==============================================================================
+import multiprocessing
+import threading
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+from fetch_core.config import EXTRACT_WORKERS, EXTRACT_TIMEOUT, EXTRACT_MEMORY_LIMIT, EXTRACT_MAX_TASKS_PER_WORKER
+from utils.data_processing import get_pdf_data, get_excel_data
+from utils.init_logger import get_logger
+
+logger = get_logger("extractor")
+
+
+def extract_attachment(attach_name, source):
+    """
+    读取附件文字内容
+
+    :param attach_name: 附件名称
+    :param source: 附件内容(bytes)或本地路径
+    :return: (页数, 文字内容)
+    :rtype: tuple
+    """
+    _index = attach_name.rfind(".")
+    _type = attach_name[_index:]
+    if _type == ".pdf":
+        return get_pdf_data(source)
+
+    if _type == ".xlsx":
+        return 1, get_excel_data(source)
+    return 0, ""
+
+
+def _worker_main(conn, memory_limit):
+    """ 解析进程: 循环接收 (附件名称, 附件内容), 返回 ("ok", (页数, 文字内容)) 或 ("error", 错误信息) """
+    if memory_limit and resource is not None:
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+    while True:
+        try:
+            task = conn.recv()
+        except EOFError:
+            break
+        if task is None:
+            break
+        attach_name, source = task
+        try:
+            conn.send(("ok", extract_attachment(attach_name, source)))
+        except MemoryError:
+            # 内存不足后进程状态不可靠, 直接退出由主进程重新创建
+            conn.send(("error", "超过内存上限"))
+            break
+        except Exception as err:
+            conn.send(("error", repr(err)))
+
+
+class _Worker:
+    __slots__ = ("process", "conn", "tasks")
+
+    def __init__(self, process, conn):
+        self.process = process
+        self.conn = conn
+        self.tasks = 0
+
+    def stop(self, timeout=0):
+        try:
+            self.conn.close()
+        finally:
+            self.process.join(timeout)
+            if self.process.is_alive():
+                self.process.kill()
+            self.process.join()
+
+
+class ExtractorPool:
+    """
+    附件解析进程池: 解析在独立进程中进行, 不占用抓取线程的GIL;
+    单个附件超时或导致进程崩溃时只结束该进程, 该附件记为空内容, 不影响邮件的其余部分
+    """
+
+    def __init__(self, workers=EXTRACT_WORKERS, timeout=EXTRACT_TIMEOUT, memory_limit=EXTRACT_MEMORY_LIMIT,
+                 max_tasks=EXTRACT_MAX_TASKS_PER_WORKER):
+        self.workers = workers
+        self.timeout = timeout
+        self.memory_limit = memory_limit
+        self.max_tasks = max_tasks
+        # 抓取进程中有上传、数据库等线程, 使用spawn避免fork时复制锁状态
+        self._context = multiprocessing.get_context("spawn")
+        self._idle = []
+        self._started = 0
+        self._cond = threading.Condition()
+
+    def _spawn(self):
+        parent_conn, child_conn = self._context.Pipe()
+        process = self._context.Process(target=_worker_main, args=(child_conn, self.memory_limit),
+                                        name="extract-worker", daemon=True)
+        process.start()
+        child_conn.close()
+        return _Worker(process, parent_conn)
+
+    def _checkout(self):
+        """ 取一个空闲进程, 进程数未达上限时新建, 否则等待 """
+        with self._cond:
+            while not self._idle and self._started >= self.workers:
+                self._cond.wait()
+            if self._idle:
+                return self._idle.pop()
+            self._started += 1
+        try:
+            return self._spawn()
+        except Exception:
+            with self._cond:
+                self._started -= 1
+                self._cond.notify()
+            raise
+
+    def _checkin(self, worker, reuse):
+        if not reuse:
+            worker.stop()
+        with self._cond:
+            if reuse:
+                self._idle.append(worker)
+            else:
+                self._started -= 1
+            self._cond.notify()
+
+    def extract(self, attach_name, source):
+        """
+        在解析进程中读取附件文字内容, 超时、进程崩溃或解析出错时返回空内容
+
+        :param attach_name: 附件名称
+        :param source: 附件内容(bytes)或本地路径
+        :return: (页数, 文字内容)
+        :rtype: tuple
+        """
+        if self.workers <= 0:
+            # 在当前线程中解析, 出错时与进程池一致记为空内容
+            try:
+                return extract_attachment(attach_name, source)
+            except Exception as err:
+                logger.error(f"附件[{attach_name}]解析失败, 记为空内容, 错误信息: {err!r}")
+                return 0, ""
+
+        worker = self._checkout()
+        reuse = False
+        try:
+            worker.conn.send((attach_name, source))
+            if not worker.conn.poll(self.timeout):
+                logger.error(f"附件[{attach_name}]解析超过{self.timeout}秒, 结束解析进程, 记为空内容")
+                return 0, ""
+            status, result = worker.conn.recv()
+            worker.tasks += 1
+            if status != "ok":
+                logger.error(f"附件[{attach_name}]解析失败, 记为空内容, 错误信息: {result}")
+                return 0, ""
+            # 处理一定数量的附件后重启进程, 释放解析过程中累积的内存
+            reuse = worker.tasks < self.max_tasks
+            return result
+        except (EOFError, OSError) as err:
+            logger.error(f"附件[{attach_name}]解析进程异常退出(exitcode: {worker.process.exitcode}), "
+                         f"记为空内容, 错误信息: {err!r}")
+            return 0, ""
+        finally:
+            self._checkin(worker, reuse)
+
+    def shutdown(self):
+        """ 结束所有空闲的解析进程 """
+        with self._cond:
+            idle, self._idle = self._idle, []
+            self._started -= len(idle)
+        for worker in idle:
+            try:
+                worker.conn.send(None)
+            except OSError:
+                pass
+            worker.stop(timeout=1)
+
+
+extractor_pool = ExtractorPool()
@@ -7,41 +7,54 @@
 import datetime
 import email
 import imaplib
-import time
+import itertools
+import re
 from email.header import decode_header
+from io import BytesIO
 
+from fetch_core.admission import attachment_policy
+from fetch_core.charset import body_decoder
 from fetch_core.config import *
-from fetch_core.db import DBManagement
-from fetch_core.tencentyun import upload_with_cos
+from fetch_core.db import DBManagement, attachment_index
+from fetch_core.extractor import extractor_pool
+from fetch_core.record import EmailRecord
+from fetch_core.spool import attachment_spool
+from fetch_core.tencentyun import cos_uploader
 from utils.decorator import retry
+from utils.exceptions import IMAPCommandException, SpoolQuotaException
+from utils.imap_utils import parse_fetch_response, compress_id_set, chunk_ids, parse_fetch_items, \
+    parse_bodystructure, iter_body_parts, build_message
 from utils.init_logger import get_logger
 from utils.time_converter import converter
-from utils.data_processing import get_file_size, email_addr_cleaning, get_decrypted_password, get_pdf_data, \
-    get_excel_data, get_uuid4
+from utils.data_processing import email_addr_cleaning, get_decrypted_password, get_content_key
 
 logger = get_logger("outlook_fetch")
 
+# 预筛选只取判断所需的邮件头字段
+HEADER_PREFILTER_FIELDS = "DATE FROM SUBJECT MESSAGE-ID"
+# 只下载需要的部分时, 先获取邮件结构和完整邮件头
+BODYSTRUCTURE_QUERY = "(BODYSTRUCTURE BODY.PEEK[HEADER])"
+# 上传失败的附件不收录, 原因写入研报摘要
+UPLOAD_FAILED_REASON = "上传至腾讯云失败"
+# 延后处理的附件写入本地附件目录时的文件名序号
+_spill_ids = itertools.count()
+
 
 class EmailInfoFetch:
 
-    def __init__(self):
+    def __init__(self, use_uid=False, db_manager=None, defer_attachments=False):
         self.imap = None
+        self.db_manager = db_manager or DBManagement()  # 整个抓取过程共用的数据库管理对象
         self.inbox_messages = None
+        self.use_uid = use_uid  # 是否使用UID SEARCH/UID FETCH
+        self.folder = None  # 当前选中的文件夹
+        self.uid_validity = None  # 当前文件夹的UIDVALIDITY
+        self.email_sizes = {}  # 邮件大小(RFC822.SIZE), 批量下载时按字节预算分批
         self.latest_report_time = None  # 数据库最新保存研报的发件时间
-
-        # email content
-        self.raw_email = None
-        self.email_message = None
-        self.subject = None
-        self.sender = None
-        self.body = None
-        self.sendtime = None
-        # email attach
-        self.attachment = []
-        self.attachment_text= ""
-        self.attachment_page = 0
-        # report other user
-        self.author = None
+        self.unverified_ids = set()  # 预筛选时邮件头获取失败、未经判断的邮件id, 完整抓取时需完整判断
+        self.defer_attachments = defer_attachments  # 附件是否延后到流水线的解析、上传阶段处理
+        # 当前邮件的处理状态, fetch_email_content 结束时生成 EmailRecord 并清空
+        self.clean_last_email_info()
 
     @retry((Exception,), tries=3, delay=2)
     def login(self, username, password):
@@ -69,7 +82,10 @@ class EmailInfoFetch:
         :return: (status, dir_message)
         :rtype: (str, list)
         """
-        return self.imap.select(dir)
+        result = self.imap.select(dir)
+        self.folder = dir
+        self.uid_validity = self._get_uid_validity()
+        return result
 
     def inbox(self):
         """
@@ -77,14 +93,39 @@ class EmailInfoFetch:
         :return: inbox_message
         :rtype: list
         """
-        status, inbox_message = self.imap.select("INBOX")
+        status, inbox_message = self.select("INBOX")
         return inbox_message
 
+    def _get_uid_validity(self):
+        """ 获取当前文件夹的UIDVALIDITY, SELECT 响应中没有时再通过 STATUS 查询 """
+        typ, data = self.imap.response("UIDVALIDITY")
+        if data and data[0]:
+            return int(data[0])
+        status, data = self.imap.status(self.folder, "(UIDVALIDITY)")
+        if status == "OK" and data and data[0]:
+            matched = re.search(rb"UIDVALIDITY (\d+)", data[0])
+            if matched:
+                return int(matched.group(1))
+        logger.error(f"获取文件夹[{self.folder}]的UIDVALIDITY失败")
+        return None
+
+    def _search(self, *criteria):
+        """ 根据同步模式执行 SEARCH 或 UID SEARCH """
+        if self.use_uid:
+            return self.imap.uid("SEARCH", None, *criteria)
+        return self.imap.search(None, *criteria)
+
+    def _fetch(self, message_set, message_parts):
+        """ 根据同步模式执行 FETCH 或 UID FETCH """
+        if self.use_uid:
+            return self.imap.uid("FETCH", message_set, message_parts)
+        return self.imap.fetch(message_set, message_parts)
+
     def read_only(self, folder):
         return self.imap.select(folder, readonly=True)
 
     def all_ids(self):
-        status, data = self.imap.search(None, "ALL")
+        status, data = self._search("ALL")
         msg_list = data[0].split()
         return msg_list
 
@@ -94,24 +135,302 @@ class EmailInfoFetch:
         return mydate.strftime("%d-%b-%Y")
 
     def all_ids_since(self, days):
-        status, data = self.imap.search(None, '(SINCE "'+self.since_date(days)+'")', 'ALL')
+        status, data = self._search('(SINCE "'+self.since_date(days)+'")', 'ALL')
         msg_list = data[0].split()
         return msg_list
 
     def all_ids_since_date(self, date_time):
         self.latest_report_time = date_time
         date = date_time.strftime("%d-%b-%Y")
-        status, data = self.imap.search(None, '(SINCE "'+date+'")', 'ALL')
+        status, data = self._search('(SINCE "'+date+'")', 'ALL')
         msg_list = data[0].split()
         logger.info(f"[{str(date_time).split()[0]}]--[{datetime.date.today()}] 共有邮件数量: {len(msg_list)}")
         return msg_list
 
+    def all_uids_after(self, last_uid):
+        """
+        获取UID大于last_uid的所有邮件
+
+        :param int last_uid: 上次处理的最后一封邮件UID
+        :return: uid列表
+        :rtype: list
+        """
+        status, data = self.imap.uid("SEARCH", None, "UID {}:*".format(last_uid + 1))
+        # "n:*" 在没有新邮件时也会返回最后一封邮件, 需要过滤
+        msg_list = [uid for uid in data[0].split() if int(uid) > last_uid]
+        logger.info(f"[UID > {last_uid}] 共有邮件数量: {len(msg_list)}")
+        return msg_list
+
+    def incremental_ids(self, checkpoint, date_time):
+        """
+        UID增量同步: UIDVALIDITY与断点一致时只取新邮件, 否则按日期全量扫描。
+        增量同步时以UID范围为准, 不再按发件时间过滤: 流水线和批量写入乱序保存, 失败后断点不推进,
+        数据库最新研报的发件时间可能晚于尚未保存的邮件
+
+        :param checkpoint: 同步断点, SyncCheckpoint对象
+        :param datetime.datetime date_time: 数据库最新保存研报的发件时间
+        :return: uid列表
+        :rtype: list
+        """
+        uid_validity, last_uid = checkpoint.load(self.folder)
+        if uid_validity is not None and uid_validity == self.uid_validity:
+            self.latest_report_time = None
+            return self.all_uids_after(last_uid)
+
+        logger.info(f"文件夹[{self.folder}]UIDVALIDITY变化({uid_validity} -> {self.uid_validity}), 按日期全量扫描")
+        return self.all_ids_since_date(date_time)
+
+    def pending_ids(self, checkpoint=None):
+        """
+        获取待处理的邮件id: 有断点且使用UID时增量获取, 否则获取数据库最新研报发件时间到现在的所有邮件
+
+        :param checkpoint: 同步断点, SyncCheckpoint对象
+        :return: 邮件id列表
+        :rtype: list
+        """
+        # 获取最新保存研报的发件时间
+        latest_report_time = self.db_manager.get_latest_report_time()
+        if self.use_uid and checkpoint is not None:
+            return self.incremental_ids(checkpoint, latest_report_time)
+        return self.all_ids_since_date(latest_report_time)
+
     def get_email(self, id):
-        status, data = self.imap.fetch(str(id), "(RFC822)")
-        self.raw_email = data[0][1]
-        self.email_message = email.message_from_bytes(self.raw_email)
+        status, data = self._fetch(str(id), "(RFC822)")
+        # 解析后不保留邮件原文
+        self.email_message = email.message_from_bytes(data[0][1])
         return self.email_message
 
+    def get_headers(self, ids, batch_size=PREFILTER_BATCH_SIZE):
+        """
+        批量获取邮件头(不下载正文和附件, 且不标记已读)
+
+        :param list ids: 邮件id列表
+        :param int batch_size: 单次FETCH的邮件数量
+        :return: {id: 仅包含邮件头的message对象}
+        :rtype: dict
+        """
+        headers = {}
+        # 同时获取邮件大小, 供批量下载时按字节预算分批
+        query = "(RFC822.SIZE BODY.PEEK[HEADER.FIELDS ({})])".format(HEADER_PREFILTER_FIELDS)
+        for batch in chunk_ids(ids, batch_size):
+            status, data = self._fetch(compress_id_set(batch), query)
+            if status != "OK":
+                logger.error(f"批量获取邮件头失败, status: {status}, 邮件id: {batch[0]}...{batch[-1]}")
+                continue
+            for item in parse_fetch_response(data):
+                key = str(item["uid"] if self.use_uid else item["seq"])
+                if item["size"] is not None:
+                    self.email_sizes[key] = item["size"]
+                if item["literal"] is not None:
+                    headers[key] = email.message_from_bytes(item["literal"])
+        return headers
+
+    def get_sizes(self, ids, batch_size=PREFILTER_BATCH_SIZE):
+        """
+        批量获取邮件大小, 已知大小的邮件不再重复获取
+
+        :param list ids: 邮件id列表
+        :param int batch_size: 单次FETCH的邮件数量
+        :return: {id: 邮件大小}
+        :rtype: dict
+        """
+        unknown = [eid for eid in ids if (eid.decode() if isinstance(eid, bytes) else str(eid)) not in self.email_sizes]
+        for batch in chunk_ids(unknown, batch_size):
+            status, data = self._fetch(compress_id_set(batch), "(RFC822.SIZE)")
+            if status != "OK":
+                logger.error(f"批量获取邮件大小失败, status: {status}, 邮件id: {batch[0]}...{batch[-1]}")
+                continue
+            for item in parse_fetch_response(data):
+                if item["size"] is not None:
+                    self.email_sizes[str(item["uid"] if self.use_uid else item["seq"])] = item["size"]
+        return self.email_sizes
+
+    def iter_emails(self, ids, batch_size=FETCH_BATCH_SIZE, byte_budget=FETCH_BATCH_BYTES):
+        """
+        批量下载完整邮件, 每批发送一次FETCH(序列集压缩为 1:50,60,72:80 的形式), 逐封返回解析后的邮件
+
+        :param list ids: 邮件id列表
+        :param int batch_size: 每批最多邮件数量
+        :param int byte_budget: 每批最多字节数
+        :return: 生成器, (邮件id, email.message.Message)
+        :raises IMAPCommandException: 有批次下载失败时, 其余批次处理完后抛出, 调用方据此不推进同步断点
+        """
+        sizes = self.get_sizes(ids) if byte_budget else None
+        failed = []
+        for batch in chunk_ids(ids, batch_size, byte_budget, sizes):
+            status, data = self._fetch(compress_id_set(batch), "(RFC822)")
+            if status != "OK":
+                logger.error(f"批量下载邮件失败, status: {status}, 邮件id: {batch[0]}...{batch[-1]}")
+                failed.extend(batch)
+                continue
+            items = parse_fetch_response(data)
+            del data
+            # 逆序弹出, 已处理的邮件原文尽早释放
+            items.reverse()
+            while items:
+                item = items.pop()
+                if item["literal"] is None:
+                    continue
+                key = str(item["uid"] if self.use_uid else item["seq"])
+                # 解析后不保留邮件原文
+                self.email_message = email.message_from_bytes(item.pop("literal"))
+                yield key, self.email_message
+        if failed:
+            raise IMAPCommandException("批量下载邮件失败 {} 封, 邮件id: {}".format(len(failed), compress_id_set(failed)))
+
+    def wanted_parts(self, structure):
+        """
+        邮件中需要下载的部分: 与 fetch_email_content 的处理一致, 只需要 text/plain、text/html 和带名称的部分;
+        带名称的部分先按附件准入策略判断(大小取BODYSTRUCTURE中的部分大小), 不收录的部分不下载
+
+        :param dict structure: parse_bodystructure 返回的邮件结构
+        :return: 需要下载的部分列表
+        :rtype: list
+        """
+        parts = []
+        total = 0
+        for part in iter_body_parts(structure):
+            named = any(key == "name" or key.startswith("name*") for key in part["params"])
+            is_body = part["type"] == "text" and part["subtype"] in ("plain", "html")
+            if named:
+                attach_name = self._part_name(part)
+                size = part["size"] * 3 // 4 if part["encoding"] == "base64" else part["size"]
+                reason = attachment_policy.reason(
+                    attach_name, "{}/{}".format(part["type"], part["subtype"]), size, total)
+                if reason is None:
+                    total += size
+                elif not is_body:
+                    self.skip_attachment(attach_name, reason)
+                    continue
+            if named or is_body:
+                parts.append(part)
+        return parts
+
+    def _part_name(self, part):
+        """ BODYSTRUCTURE中部分的名称(RFC2231分段的名称按顺序拼接) """
+        params = part["params"]
+        if params.get("name"):
+            return self.decode(params["name"])
+        segments = sorted((key, value) for key, value in params.items() if key.startswith("name*"))
+        return "".join(value or "" for key, value in segments)
+
+    def get_sections(self, ids, sections):
+        """
+        一次FETCH下载多封邮件的相同部分(不标记已读)
+
+        :param list ids: 邮件id列表
+        :param list sections: section编号列表, 如 ["1.1", "2"]
+        :return: {邮件id: {section: 未解码的部分内容}}, 响应中缺少的部分不在结果中
+        :rtype: dict
+        :raises IMAPCommandException: FETCH失败
+        """
+        query = "({})".format(" ".join("BODY.PEEK[{}]".format(section) for section in sections))
+        status, data = self._fetch(compress_id_set(ids), query)
+        if status != "OK":
+            raise IMAPCommandException("下载邮件部分失败, status: {}, 邮件id: {}, section: {}".format(
+                status, compress_id_set(ids), sections))
+        result = {}
+        for seq, fields in parse_fetch_items(data):
+            contents = result.setdefault(str(fields.get("UID") if self.use_uid else seq), {})
+            for section in sections:
+                content = fields.get("BODY[{}]".format(section))
+                if isinstance(content, bytes):
+                    contents[section] = content
+        return result
+
+    def iter_email_parts(self, ids, batch_size=FETCH_BATCH_SIZE, byte_budget=FETCH_BATCH_BYTES):
+        """
+        先批量获取邮件结构(BODYSTRUCTURE)和邮件头, 再只下载正文和附件部分,
+        内嵌图片、签名、日历等不需要的部分不再下载; 传输编码在本地解码。
+        需要下载的部分(section列表)相同的邮件按数量和字节预算合并为一次FETCH
+
+        :param list ids: 邮件id列表
+        :param int batch_size: 每批获取邮件结构、下载邮件部分的邮件数量
+        :param int byte_budget: 每次下载邮件部分最多字节数(按邮件结构中的部分大小计算)
+        :return: 生成器, (邮件id, email.message.Message), 与 iter_emails 一致
+        :raises IMAPCommandException: 有邮件获取失败时, 其余邮件处理完后抛出, 调用方据此不推进同步断点
+        """
+        failed = []
+        for batch in chunk_ids(ids, batch_size):
+            status, data = self._fetch(compress_id_set(batch), BODYSTRUCTURE_QUERY)
+            if status != "OK":
+                logger.error(f"批量获取邮件结构失败, status: {status}, 邮件id: {batch[0]}...{batch[-1]}")
+                failed.extend(batch)
+                continue
+            items = parse_fetch_items(data)
+            del data
+            messages = {}  # 邮件id -> (邮件头, 邮件结构, 需要的部分, 下载前跳过的附件)
+            groups = {}  # section列表 -> [邮件id, ...]
+            sizes = {}
+            for seq, fields in items:
+                key = str(fields.get("UID") if self.use_uid else seq)
+                header, body = fields.get("BODY[HEADER]"), fields.get("BODYSTRUCTURE")
+                if not isinstance(header, bytes) or not isinstance(body, list):
+                    logger.error(f"邮件id: {key} 的邮件结构获取失败")
+                    failed.append(key)
+                    continue
+                structure = parse_bodystructure(body)
+                parts = self.wanted_parts(structure)
+                # wanted_parts 记录的跳过附件属于这封邮件, 产出该邮件时再放回
+                messages[key] = (header, structure, parts, self.skipped_attachments)
+                self.skipped_attachments = []
+                groups.setdefault(tuple(part["section"] for part in parts), []).append(key)
+                sizes[key] = sum(part["size"] for part in parts)
+            del items
+
+            for sections, keys in groups.items():
+                for chunk in chunk_ids(keys, batch_size, byte_budget, sizes):
+                    try:
+                        contents = self.get_sections(chunk, list(sections)) if sections else {}
+                    except IMAPCommandException as err:
+                        logger.error(str(err))
+                        failed.extend(chunk)
+                        continue
+                    for key in chunk:
+                        header, structure, parts, skipped = messages.pop(key)
+                        sections_content = contents.pop(key, {})
+                        missing = [section for section in sections if section not in sections_content]
+                        if missing:
+                            # 缺少部分内容时不能保存不完整的邮件, 记为失败, 下次运行重新处理
+                            logger.error(f"邮件id: {key} 的部分 {missing} 下载失败")
+                            failed.append(key)
+                            continue
+                        self.skipped_attachments = skipped
+                        self.email_message = build_message(header, structure, parts, sections_content)
+                        yield key, self.email_message
+        if failed:
+            raise IMAPCommandException("获取邮件失败 {} 封, 邮件id: {}".format(len(failed), compress_id_set(failed)))
+
+    def prefilter_ids(self, ids, headers=None):
+        """
+        根据邮件头预筛选邮件, 只有通过 发件时间/白名单/标题重复 判断的邮件才需要完整下载。
+        邮件头获取失败的邮件也需要完整下载, 其id记入 self.unverified_ids, 完整抓取时调用方需传入以完整判断
+
+        :param list ids: 邮件id列表
+        :param dict headers: 已获取的邮件头 {id: message}, 为None时通过当前连接批量获取
+        :return: 需要完整抓取的邮件id列表
+        :rtype: list
+        """
+        if headers is None:
+            headers = self.get_headers(ids)
+        survivors = []
+        self.unverified_ids = set()
+        for eid in ids:
+            key = eid.decode() if isinstance(eid, bytes) else str(eid)
+            header = headers.get(key)
+            if header is None:
+                # 邮件头获取失败, 交由完整抓取后再判断
+                survivors.append(eid)
+                self.unverified_ids.add(key)
+                continue
+            self.email_message = header
+            if self.check_email():
+                survivors.append(eid)
+            self.clean_last_email_info()
+        logger.info(f"邮件头预筛选完成, 共 {len(ids)} 封邮件, 需完整抓取 {len(survivors)} 封, "
+                    f"其中邮件头获取失败 {len(self.unverified_ids)} 封")
+        return survivors
+
     def maildatetime(self):
         self.sendtime = self.email_message["DATE"]
         # print("self.sendtime:{}".format(self.sendtime))
@@ -131,6 +450,11 @@ class EmailInfoFetch:
         logger.info("邮件发件人: {}".format(self.sender))
         return self.sender
 
+    def mail_message_id(self):
+        raw_message_id = self.email_message["MESSAGE-ID"]
+        self.message_id = raw_message_id.strip() if raw_message_id else None
+        return self.message_id
+
     def mailsubject(self):
         raw_subject = self.email_message["SUBJECT"]
         detail, encoding = decode_header(raw_subject)[0]
@@ -150,18 +474,22 @@ class EmailInfoFetch:
 
     def clean_last_email_info(self):
         # email content
-        self.raw_email = None
         self.email_message = None
         self.subject = None
         self.sender = None
-        self.body = None
+        self.body_parts = []  # 正文片段, 生成记录时拼接一次
         self.sendtime = None
         # email attach
         self.attachment = []
-        self.attachment_text= ""
+        self.attachment_texts = []  # 附件文字片段, 生成记录时拼接一次
         self.attachment_page = 0
+        self.uploads = []  # 附件后台上传的 (attach_uuid, Future)
+        self.skipped_attachments = []  # 未收录的附件 (附件名称, 原因)
+        self.pending_attachments = []  # 延后处理的附件, 见 _admit_attach
         # report other user
         self.author = None
+        # 邮件唯一标识, 用于生成研报唯一键
+        self.message_id = None
 
     @staticmethod
     def decode(data):
@@ -175,88 +503,279 @@ class EmailInfoFetch:
         attachment = message.get_payload(decode=True)
         return attachment
 
+    def sender_domain(self):
+        """ 发件人邮箱域名(小写) """
+        if not self.sender or "@" not in self.sender:
+            return None
+        return self.sender.rpartition("@")[2].lower()
+
     def get_body(self, message):
-        try:
-            return message.get_payload(decode=True).decode()
-        except UnicodeDecodeError as err:
-            logger.info(f"{self.subject} 正文[UTF-8]解码错误, err message: {err}")
-            try:
-                # print(message.get_payload(decode=True).decode(ENCODING_GB18030))
-                return message.get_payload(decode=True).decode(ENCODING_GB18030)
-            except UnicodeDecodeError as err:
-                logger.info(f"{self.subject} 正文[GB18030]解码错误, err message: {err}")
-                # print(message.get_payload(decode=True).decode(ENCODING_ISO_8859_1))
-                return message.get_payload(decode=True).decode(ENCODING_ISO_8859_1)
+        """ 正文只解码一次传输编码, 字符集按 声明 -> 该发件域名上次使用 -> 备选 的顺序尝试 """
+        return body_decoder.decode(message.get_payload(decode=True), message.get_content_charset(),
+                                   self.sender_domain())
 
     @staticmethod
-    def _download_and_uplaod(attach_name, attachment):
+    def _download_and_uplaod(attach_uuid, attachment, scope, upload=True):
         """
         下载附件并上传至腾讯云
 
-        :param attach_name: 附件名称
+        :param attach_uuid: 附件键(内容哈希+文件类型), 同时作为本地文件名和腾讯云对象键
         :param attachment: 附件内容
-        :return: 上传腾讯云成功返回的etag, 附件本地绝对路径
+        :param scope: 本地附件作用域 SpoolScope, 退出作用域且上传完成后删除本地附件
+        :param bool upload: 是否上传, 已上传过的附件只落盘供解析
+        :return: 附件本地绝对路径, 上传Future(不上传时为None)
         :rtype: tuple
         """
-        index_dot = attach_name.rfind(".")
-        attach_type = attach_name[index_dot:]
-        original_attach_name = attach_name
-        attach_name = get_uuid4() + attach_type  # 用"自己生成的uuid+文件类型"命名
-        try:
-            # 下载附件
-            storepath = LOCAL_ATTACHMENT_ABSPATH + "{}".format(attach_name)
-            with open(storepath, "wb") as f:
-                f.write(attachment)
-            logger.info(f"下载附件[{attach_name}]至本地成功")
-        except Exception as err:
-            # 遇到附件名中有特殊字符的附件，用时间戳命名该附件
-            attach_name = str(int(time.time())) + attach_type
-            storepath = LOCAL_ATTACHMENT_ABSPATH + "{}".format(attach_name)
-            with open(storepath, "wb") as f:
-                f.write(attachment)
-                logger.info(f"下载附件[{original_attach_name}]至本地失败，修改附件名为{attach_name}下载成功")
+        # 下载附件(附件键只含十六进制字符和文件类型, 可直接作为本地文件名)
+        storepath = scope.write(attach_uuid, attachment)
+        logger.info(f"下载附件[{attach_uuid}]至本地成功")
 
-        # 上传至腾讯云
-        etag = upload_with_cos(attach_name)
+        if not upload:
+            return storepath, None
+        # 后台上传至腾讯云
+        future = cos_uploader.submit(attach_uuid, local_file_path=storepath)
+        scope.release_after(storepath, future)
 
-        return attach_name, storepath
+        return storepath, future
+
+    @staticmethod
+    def _upload_from_memory(attach_uuid, attachment):
+        """
+        从内存上传附件至腾讯云
+
+        :param attach_uuid: 附件键(内容哈希+文件类型)
+        :param bytes attachment: 附件内容
+        :return: 上传Future
+        :rtype: concurrent.futures.Future
+        """
+        return cos_uploader.submit(attach_uuid, body=BytesIO(attachment))
 
     def _build_attach(self, message):
         """
-        构造附件信息结构, 保存该结构到self.attachment, 删除本地附件
+        构造附件信息结构, 保存该结构到self.attachment, 删除本地附件。
+        附件键由内容哈希生成, 已上传过的附件不再上传, 已解析过的附件直接使用缓存的文字内容;
+        defer_attachments 为True时只记录待处理附件, 由流水线的解析、上传阶段处理
 
         :param message: email的message对象
         :return: (attach_uuid, attach_name, attach_size)
         :rtype: tuple
         """
+        pending = self._admit_attach(message)
+        if pending is None:
+            return
+        if self.defer_attachments:
+            pending = self._spill_pending(pending)
+            if pending is None:
+                return
+            self.pending_attachments.append(pending)
+        elif not self._process_attach(pending):
+            return
+        self.attachment.append((pending["uuid"], pending["name"], pending["size"]))
+
+    def _admit_attach(self, message):
+        """
+        按准入策略判断附件是否收录, 生成附件键并判断是否需要上传
 
+        :param message: email的message对象
+        :return: 待处理附件 {"uuid", "name", "size", "payload", "path", "upload", "waiting", "extracted"}, 不收录时返回None
+        :rtype: dict
+        """
         attach_name = self.decode(message.get_param("name"))
         attachment = self.get_attachment(message)
         if not attachment:
             logger.error(f"邮件标题:[{self.subject}] 的附件内容获取失败")
-        attach_uuid, attach_abspath = self._download_and_uplaod(attach_name, attachment)
-        attach_size = get_file_size(attach_abspath)
+        payload = attachment or b""
+        reason = attachment_policy.reason(attach_name, message.get_content_type(), len(payload),
+                                          sum(attach[2] for attach in self.attachment))
+        if reason is not None:
+            self.skip_attachment(attach_name, reason)
+            return None
+        attach_uuid = get_content_key(payload, attach_name[attach_name.rfind("."):])
+        attach_size = len(payload)
         logger.info("邮件附件名称: {}".format(attach_name))
-        # 读取附件内容
-        _index = attach_name.rfind(".")
-        _type = attach_name[_index:]
-        if _type == ".pdf":
-            page_num, attachment_text = get_pdf_data(attach_abspath)
-            self.attachment_page += page_num
-            self.attachment_text += attachment_text
-
-        if _type == ".xlsx":
-            attachment_text = get_excel_data(attach_abspath)
-            self.attachment_page += 1
-            self.attachment_text += attachment_text
-
-        # 删除本地附件
-        self.remove_local_attach(attach_uuid)
-
-        self.attachment.append((attach_uuid, attach_name, attach_size))
-
-    def fetch_email_content(self):
-        # 先判断是否需要抓取
+
+        # waiting: 相同内容的附件正在由其它邮件上传时为该上传的Future
+        upload, waiting = attachment_index.claim(attach_uuid, attach_size)
+        if not upload:
+            logger.info(f"附件[{attach_name}]已上传过, 复用附件[{attach_uuid}]")
+        return {
+            "uuid": attach_uuid,
+            "name": attach_name,
+            "size": attach_size,
+            "payload": payload,
+            "path": None,  # 写入本地附件目录后的路径, 此时payload为None
+            "upload": upload,
+            "waiting": waiting,
+            "extracted": None if upload else attachment_index.get_text(attach_uuid),  # (页数, 文字内容)
+        }
+
+    def _spill_pending(self, pending):
+        """
+        延后处理的附件较大(或不在内存中处理)时写入本地附件目录, 流水线各阶段之间只传递路径,
+        附件内容占用的内存和磁盘分别受流水线队列字节数和本地附件目录配额限制
+
+        :return: 待处理附件, 本地附件目录空间不足时返回None(附件记为不收录)
+        :rtype: dict
+        """
+        if ATTACHMENT_IN_MEMORY and pending["size"] <= ATTACHMENT_SPILL_THRESHOLD:
+            return pending
+        # 相同内容的附件可能同时在多封邮件中待处理, 文件名加序号区分, 保留文件类型供解析
+        name = "{}-{}".format(next(_spill_ids), pending["uuid"])
+        try:
+            path = attachment_spool.write(name, pending["payload"])
+        except SpoolQuotaException as err:
+            logger.error(f"附件[{pending['name']}]写入本地失败, 错误信息: {err}")
+            if pending["upload"]:
+                attachment_index.finish(pending["uuid"], err)
+            self.skip_attachment(pending["name"], "本地附件目录空间不足")
+            return None
+        return dict(pending, payload=None, path=path)
+
+    def _process_attach(self, pending):
+        """
+        在当前线程上传(后台队列)和解析附件
+
+        :return: 本地附件目录空间不足时返回False(附件记为不收录)
+        :rtype: bool
+        """
+        attach_uuid, payload, extracted = pending["uuid"], pending["payload"], pending["extracted"]
+        if extracted is None:
+            try:
+                extracted = self._upload_and_extract(pending)
+            except SpoolQuotaException as err:
+                logger.error(f"附件[{pending['name']}]写入本地失败, 错误信息: {err}")
+                if pending["upload"]:
+                    attachment_index.finish(attach_uuid, err)
+                self.skip_attachment(pending["name"], "本地附件目录空间不足")
+                return False
+            except Exception as err:
+                # 占用的附件键必须结束, 否则相同内容的附件一直等待
+                if pending["upload"]:
+                    attachment_index.finish(attach_uuid, err)
+                raise
+            attachment_index.set_text(attach_uuid, *extracted)
+        if pending["waiting"] is not None:
+            # 相同内容的附件正在由其它邮件上传, 保存前一并等待, 上传失败时本邮件也不收录该附件
+            self.uploads.append((attach_uuid, pending["waiting"]))
+
+        page_num, attachment_text = extracted
+        self.attachment_page += page_num
+        self.attachment_texts.append(attachment_text)
+        return True
+
+    def _upload_and_extract(self, pending):
+        """
+        上传(后台队列)并解析附件, 附件较大时先写入本地附件目录
+
+        :return: (页数, 文字内容)
+        :rtype: tuple
+        :raises SpoolQuotaException: 本地附件目录空间不足
+        """
+        attach_uuid, payload = pending["uuid"], pending["payload"]
+        # 落盘的附件在退出作用域(且上传完成)时按路径删除
+        with attachment_spool.scope() as scope:
+            if ATTACHMENT_IN_MEMORY and pending["size"] <= ATTACHMENT_SPILL_THRESHOLD:
+                # 直接从内存上传和解析, 不落盘
+                future = self._upload_from_memory(attach_uuid, payload) if pending["upload"] else None
+                source = payload
+            else:
+                source, future = self._download_and_uplaod(attach_uuid, payload, scope, pending["upload"])
+            if future is not None:
+                self.uploads.append((attach_uuid, future))
+                # 上传结束时结束附件键的占用, 上传失败时释放附件键, 相同内容的附件之后重新上传
+                future.add_done_callback(lambda f: attachment_index.finish(attach_uuid, f.exception()))
+            # 读取附件内容(与上传并行)
+            return extractor_pool.extract(pending["name"], source)
+
+    @staticmethod
+    def extract_pending_attachments(record):
+        """
+        解析待处理附件的文字内容(流水线解析阶段)
+
+        :param EmailRecord record: 邮件记录
+        :return: 补充了附件文字内容和页数的新记录(待处理附件替换为带解析结果的新dict, 不修改原记录)
+        :rtype: EmailRecord
+        """
+        attachment_page, attachment_texts = record.attachment_page, [record.attachment_text]
+        pending_attachments = []
+        for pending in record.pending_attachments:
+            if pending["extracted"] is None:
+                extracted = extractor_pool.extract(pending["name"], pending["path"] or pending["payload"])
+                attachment_index.set_text(pending["uuid"], *extracted)
+                pending = dict(pending, extracted=extracted)
+            page_num, attachment_text = pending["extracted"]
+            attachment_page += page_num
+            attachment_texts.append(attachment_text)
+            pending_attachments.append(pending)
+        return record._replace(attachment_text="".join(attachment_texts), attachment_page=attachment_page,
+                               pending_attachments=tuple(pending_attachments))
+
+    @staticmethod
+    def upload_pending_attachments(record):
+        """
+        上传待处理附件(流水线上传阶段), 上传失败的附件不收录, 上传结束后删除写入本地附件目录的附件。
+        相同内容的附件由其它邮件上传且尚未成功时本邮件也上传一次, 不在流水线中等待其它邮件
+
+        :param EmailRecord record: 邮件记录
+        :return: 不再引用附件内容的新记录
+        :rtype: EmailRecord
+        """
+        failed = set()
+        for pending in record.pending_attachments:
+            try:
+                EmailInfoFetch._upload_pending(pending, failed)
+            finally:
+                if pending["path"]:
+                    attachment_spool.release(pending["path"])
+        return record.drop_attachments(failed, UPLOAD_FAILED_REASON)._replace(pending_attachments=())
+
+    @staticmethod
+    def discard_pending_attachments(pending_attachments, error):
+        """
+        邮件处理失败、不再保存时释放待处理附件: 删除写入本地附件目录的文件, 结束占用的附件键,
+        否则文件一直占用本地附件目录配额, 相同内容的附件一直等待
+
+        :param pending_attachments: 待处理附件, 见 _admit_attach
+        :param Exception error: 处理失败的原因
+        """
+        for pending in pending_attachments:
+            if pending["path"]:
+                attachment_spool.release(pending["path"])
+            if pending["upload"]:
+                attachment_index.finish(pending["uuid"], error)
+
+    @staticmethod
+    def _upload_pending(pending, failed):
+        """ 上传一个待处理附件, 上传失败时把附件键加入failed """
+        waiting = pending["waiting"]
+        if not pending["upload"] and (waiting is None or (waiting.done() and waiting.exception() is None)):
+            return
+        try:
+            if pending["path"]:
+                cos_uploader.upload(pending["uuid"], local_file_path=pending["path"])
+            else:
+                cos_uploader.upload(pending["uuid"], body=BytesIO(pending["payload"]))
+        except Exception as err:
+            failed.add(pending["uuid"])
+            logger.error(f"附件[{pending['uuid']}]上传至腾讯云失败！！错误信息: {err}")
+            if pending["upload"]:
+                attachment_index.finish(pending["uuid"], err)
+        else:
+            if pending["upload"]:
+                attachment_index.finish(pending["uuid"])
+
+    def skip_attachment(self, attach_name, reason):
+        """ 记录未收录的附件, 保存时写入研报摘要 """
+        logger.info(f"附件[{attach_name}]不收录: {reason}")
+        self.skipped_attachments.append((attach_name, reason))
+
+    def check_email(self):
+        """
+        判断当前邮件是否需要抓取(只依赖邮件头)
+
+        :return: True 需要抓取, False 跳过
+        :rtype: bool
+        """
         self.converted_datetime()
         # 判断邮件发件时间
         if self.if_earlier_than_report_time():
@@ -269,58 +788,118 @@ class EmailInfoFetch:
         self.mailsubject()
         if self.if_subject_repeat():
             return False
+        return True
+
+    def fetch_email_content(self, prefiltered=False):
+        """
+        抓取邮件正文和附件, 结束后清空当前邮件的处理状态(包括邮件对象)
 
-        # 邮件正文，邮件附件
-        if self.email_message.is_multipart():
+        :param bool prefiltered: 是否已经通过邮件头预筛选, 预筛选过的邮件不再重复判断发件时间和标题
+        :return: 抓取成功返回邮件记录, 跳过返回None
+        :rtype: EmailRecord
+        """
+        try:
+            if prefiltered:
+                self.converted_datetime()
+                self.sender_addr()
+                self.mailsubject()
+                # 仍需获取机构名
+                if not self.if_sender_in_white_list():
+                    return None
+            elif not self.check_email():
+                return None
+            self.mail_message_id()
+
+            # 邮件正文，邮件附件(非multipart邮件的 walk 只返回邮件本身)
             for message in self.email_message.walk():
                 content_type = message.get_content_type()
                 if content_type == "text/plain":
-                    body = self.get_body(message)
-                    self.body = body
+                    # 纯文本正文覆盖之前的正文
+                    self.body_parts = [self.get_body(message)]
 
                 if content_type == "text/html":
                     body = self.get_body(message)
-                    if self.body is None and body is not None:
-                        self.body = body
-                    elif self.body and body:
-                        self.body = self.body + "\n" + body
+                    if body:
+                        self.body_parts.append(body)
 
                 if message.get_param("name"):
                     self._build_attach(message)
 
-        else:
-            message = self.email_message
-            content_type = message.get_content_type()
-
-            if content_type == "text/plain":
-                body = self.get_body(message)
-                self.body = body
-
-            if content_type == "text/html":
-                body = self.get_body(message)
-                if self.body is None and body:
-                    self.body = body
-                if self.body and body:
-                    self.body = self.body + "\n" + body
-
-            if message.get_param("name"):
-                self._build_attach(message)
-        return True
+            return EmailRecord(
+                subject=self.subject,
+                sender=self.sender,
+                sendtime=self.sendtime,
+                author=self.author,
+                message_id=self.message_id,
+                body="\n".join(self.body_parts),
+                attachments=tuple(self.attachment),
+                attachment_text="".join(self.attachment_texts),
+                attachment_page=self.attachment_page,
+                skipped_attachments=tuple(self.skipped_attachments),
+                pending_attachments=tuple(self.pending_attachments),
+                uploads=tuple(self.uploads),
+            )
+        except Exception as err:
+            self.discard_pending_attachments(self.pending_attachments, err)
+            raise
+        finally:
+            self.clean_last_email_info()
 
-    def save_email(self):
-        """ 保存Email信息到MySQL数据库 """
-        email_data = {
-            "subject": self.subject,
-            "sender": self.sender,
-            "body": self.body,
-            "datetime": self.sendtime,
-            "attachment_list": self.attachment,
-            "author": self.author,
-            "attachment_text": self.attachment_text,
-            "attachment_page": self.attachment_page
-        }
+    def fetch_and_save(self, ids, writer=None, unverified=()):
+        """
+        批量下载邮件, 抓取满足条件的邮件内容并保存
+
+        :param list ids: 已通过预筛选的邮件id列表
+        :param writer: 批量写入器 ReportBatchWriter, 为None时逐封保存
+        :param unverified: 预筛选时未经判断的邮件id(prefilter_ids 的 unverified_ids), 需完整判断
+        :return: 抓取的邮件数量
+        :rtype: int
+        """
+        saved = 0
+        messages = self.iter_email_parts(ids) if FETCH_MODE == "bodystructure" else self.iter_emails(ids)
+        for eid, message in messages:
+            # 抓取前判断是否满足抓取需要
+            record = self.fetch_email_content(prefiltered=eid not in unverified)
+            if record is None:
+                continue
+
+            # 保存邮件内容
+            self.save_email(record, writer)
+            saved += 1
+        return saved
+
+    def save_email(self, record, writer=None):
+        """
+        保存Email信息到MySQL数据库
+
+        :param EmailRecord record: 邮件记录
+        :param writer: 批量写入器 ReportBatchWriter, 为None时直接保存
+        """
+        # 附件上传完成后再保存研报, 上传失败的附件不收录, 不写入附件表
+        record = record.drop_attachments(self.wait_uploads(record.uploads), UPLOAD_FAILED_REASON)
+        if writer is not None:
+            writer.add(record.to_data())
+            return
         # 保存至MySQL
-        DBManagement().save_email_to_mysql(email_data)
+        self.db_manager.save_email_to_mysql(record.to_data())
+
+    @staticmethod
+    def wait_uploads(uploads):
+        """
+        等待邮件的附件全部上传完成
+
+        :param uploads: 附件后台上传的 ((attach_uuid, Future), ...)
+        :return: 上传失败的附件键
+        :rtype: set
+        """
+        failed = set()
+        for attach_uuid, future in uploads:
+            try:
+                future.result()
+            except Exception as err:
+                failed.add(attach_uuid)
+                logger.error(f"附件[{attach_uuid}]上传至腾讯云失败！！错误信息: {err}")
+        return failed
 
     @staticmethod
     def remove_local_attach(filename, dir_abspath=None):
@@ -331,23 +910,17 @@ class EmailInfoFetch:
         :param dir_abspath: 目标目录绝对路径
         :return:
         """
-        if not dir_abspath:
-            items = os.listdir(LOCAL_ATTACHMENT_ABSPATH)
-        else:
-            items = os.listdir(dir_abspath)
-        for item in items:
-            # item = item.split(".")[0]
-            if filename == item:
-                os.remove(os.path.join(LOCAL_ATTACHMENT_ABSPATH, item))
-                logger.info(f"本地删除附件[{filename}]成功")
+        attachment_spool.release(os.path.join(dir_abspath or LOCAL_ATTACHMENT_ABSPATH, filename))
 
     def if_earlier_than_report_time(self):
         """
         判断当前抓取邮件发件时间是否早于数据库最新研报表中邮件的发件时间
 
-        :return: True表示早于，False表示晚于
+        :return: True表示早于，False表示晚于; 按UID增量同步(latest_report_time为None)时不按发件时间过滤
         :rtype: bool
         """
+        if self.latest_report_time is None:
+            return False
 
         email_sendtime = datetime.datetime.strptime(self.sendtime, '%Y-%m-%d %H:%M:%S')
         if self.latest_report_time >= email_sendtime:
@@ -365,7 +938,7 @@ class EmailInfoFetch:
         :return: True表示在白名单，False表示不在白名单
         :rtype: bool
         """
-        author = DBManagement().get_author(self.sender)
+        author = self.db_manager.get_author(self.sender)
         if author is None:
             return False
         else:
@@ -379,7 +952,7 @@ class EmailInfoFetch:
         :return: True 存在, False 不存在
         :rtype: bool
         """
-        if DBManagement().if_report_name_repeat(self.subject):
+        if self.db_manager.if_report_name_repeat(self.subject):
             return True
         else:
             return False
@@ -0,0 +1,314 @@
+# -*- coding: utf-8 -*-
+# ==============================================================================
+# @ Author :
+# @ Desc : 抓取流水线(下载 -> 解析邮件 -> 解析附件 -> 上传附件 -> 保存数据库)
+# @ Date : 2021/6/24
+# ==============================================================================
+import queue
+import threading
+
+from fetch_core.config import EMAIL_USERNAME, EMAIL_PASSWORD, SYNC_MODE, FETCH_MODE, FETCH_BATCH_SIZE, \
+    PIPELINE_WORKERS, PIPELINE_QUEUE_SIZE, PIPELINE_QUEUE_BYTES, PIPELINE_REPORT_INTERVAL
+from fetch_core.outlook import EmailInfoFetch
+from utils.imap_utils import chunk_ids
+from utils.init_logger import get_logger
+
+logger = get_logger("pipeline")
+
+_STOP = object()
+
+
+def message_bytes(item):
+    """ 解析阶段输入 (邮件, 跳过的附件, 是否已预筛选) 占用的字节数: 各部分未解码内容的长度 """
+    message = item[0]
+    return sum(len(part.get_payload()) for part in message.walk() if not part.is_multipart())
+
+
+def record_bytes(record):
+    """ 邮件记录占用的字节数: 正文、附件文字和仍在内存中的待处理附件内容 """
+    return len(record.body) + len(record.attachment_text) + \
+        sum(len(pending["payload"]) for pending in record.pending_attachments if pending["payload"])
+
+
+class Stage:
+    """
+    流水线的一个阶段: 多个工作线程从有界输入队列取数据, 处理结果放入下一阶段的队列,
+    下一阶段队列的数量或字节数达到上限时等待(背压)
+    """
+
+    def __init__(self, name, handler, workers=1, queue_size=PIPELINE_QUEUE_SIZE, on_exit=None,
+                 queue_bytes=PIPELINE_QUEUE_BYTES, sizeof=None, on_error=None):
+        """
+        :param str name: 阶段名称
+        :param handler: 处理函数 handler(item, emit), 调用 emit(result) 将结果交给下一阶段, 可调用多次或不调用
+        :param int workers: 工作线程数
+        :param int queue_size: 输入队列长度
+        :param on_exit: 工作线程退出时在该线程中调用的函数
+        :param int queue_bytes: 输入队列中数据占用内存的上限(字节), 为0时不限制; 队列为空时单个超过上限的数据也允许放入
+        :param sizeof: 计算数据占用内存字节数的函数, 为None时只按数量限制
+        :param on_error: 处理失败时调用的函数 on_error(item, err), 用于释放数据占用的资源
+        """
+        self.name = name
+        self.handler = handler
+        self.workers = max(workers, 1)
+        self.on_exit = on_exit
+        self.on_error = on_error
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.queue_bytes = queue_bytes if sizeof is not None else 0
+        self.sizeof = sizeof
+        self.next_stage = None
+        self._threads = []
+        self._lock = threading.Lock()
+        self._bytes = 0  # 输入队列中数据占用的字节数
+        self._bytes_cond = threading.Condition()
+        # 统计
+        self.processed = 0
+        self.errors = 0
+        self.max_depth = 0
+        self._depth_total = 0
+        self._samples = 0
+
+    def put(self, item):
+        size = 0
+        if self.queue_bytes:
+            size = self.sizeof(item)
+            with self._bytes_cond:
+                self._bytes_cond.wait_for(lambda: not self._bytes or self._bytes + size <= self.queue_bytes)
+                self._bytes += size
+        self.queue.put((item, size))
+
+    @property
+    def queued_bytes(self):
+        """ 输入队列中数据占用的字节数 """
+        return self._bytes
+
+    def _taken(self, size):
+        """ 数据已从输入队列取出, 释放占用的字节数 """
+        if size:
+            with self._bytes_cond:
+                self._bytes -= size
+                self._bytes_cond.notify_all()
+
+    def _emit(self, item):
+        if self.next_stage is not None:
+            self.next_stage.put(item)
+
+    def _work(self):
+        try:
+            while True:
+                item, size = self.queue.get()
+                if item is _STOP:
+                    break
+                self._taken(size)
+                try:
+                    self.handler(item, self._emit)
+                except Exception as err:
+                    with self._lock:
+                        self.errors += 1
+                    logger.error(f"流水线阶段[{self.name}]处理失败, 错误信息: {err}")
+                    self._discard(item, err)
+                # 不再引用已处理的数据, 尽早释放
+                item = None
+                with self._lock:
+                    self.processed += 1
+        finally:
+            if self.on_exit is not None:
+                try:
+                    self.on_exit()
+                except Exception as err:
+                    logger.error(f"流水线阶段[{self.name}]退出处理失败, 错误信息: {err}")
+
+    def _discard(self, item, err):
+        if self.on_error is None:
+            return
+        try:
+            self.on_error(item, err)
+        except Exception as error:
+            logger.error(f"流水线阶段[{self.name}]释放失败数据出错, 错误信息: {error}")
+
+    def start(self):
+        for index in range(self.workers):
+            thread = threading.Thread(target=self._work, name="{}-{}".format(self.name, index), daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        """ 等待队列中已有的数据处理完后结束所有工作线程 """
+        for _ in self._threads:
+            self.queue.put((_STOP, 0))
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def sample(self):
+        """ 记录当前队列深度 """
+        depth = self.queue.qsize()
+        with self._lock:
+            self.max_depth = max(self.max_depth, depth)
+            self._depth_total += depth
+            self._samples += 1
+        return depth
+
+    def stats(self):
+        with self._lock:
+            return {
+                "name": self.name,
+                "workers": self.workers,
+                "processed": self.processed,
+                "errors": self.errors,
+                "max_depth": self.max_depth,
+                "avg_depth": round(self._depth_total / self._samples, 1) if self._samples else 0,
+            }
+
+
+class Pipeline:
+    """ 由有界队列串联的多个阶段, 按阶段顺序依次排空和结束 """
+
+    def __init__(self, stages, report_interval=PIPELINE_REPORT_INTERVAL):
+        self.stages = stages
+        self.report_interval = report_interval
+        for stage, next_stage in zip(stages, stages[1:]):
+            stage.next_stage = next_stage
+        self._stopped = threading.Event()
+
+    def report(self):
+        """ 输出各阶段当前队列深度 """
+        depths = ", ".join("{} {}/{} ({}MB)".format(stage.name, stage.sample(), stage.queue.maxsize,
+                                                   stage.queued_bytes // (1024 * 1024)) for stage in self.stages)
+        logger.info(f"流水线队列深度: {depths}")
+
+    def _monitor(self):
+        while not self._stopped.wait(self.report_interval):
+            self.report()
+
+    def run(self, items):
+        """
+        将items逐个放入第一个阶段, 全部处理完成后返回
+
+        :param items: 第一个阶段的输入
+        :return: 各阶段处理失败的总次数
+        :rtype: int
+        """
+        for stage in self.stages:
+            stage.start()
+        monitor = threading.Thread(target=self._monitor, name="pipeline-monitor", daemon=True)
+        monitor.start()
+        try:
+            for item in items:
+                self.stages[0].put(item)
+        finally:
+            # 上一阶段全部结束后再结束下一阶段, 保证队列中的数据都被处理
+            for stage in self.stages:
+                stage.stop()
+            self._stopped.set()
+            monitor.join()
+
+        for stats in (stage.stats() for stage in self.stages):
+            logger.info("流水线阶段[{name}]: 线程 {workers} 个, 处理 {processed} 个, 失败 {errors} 个, "
+                        "队列深度 最大 {max_depth} 平均 {avg_depth}".format(**stats))
+        return sum(stage.errors for stage in self.stages)
+
+
+class EmailPipeline:
+    """
+    邮件抓取流水线: 下载邮件、解析正文、解析附件、上传附件、保存数据库 分别在各自的线程中进行,
+    网络下载、附件解析、上传和数据库写入互相重叠
+    """
+
+    def __init__(self, db_manager, writer, latest_report_time, workers=None, queue_size=PIPELINE_QUEUE_SIZE,
+                 queue_bytes=PIPELINE_QUEUE_BYTES, unverified=()):
+        """
+        :param db_manager: 共用的数据库管理对象
+        :param writer: 批量写入器 ReportBatchWriter
+        :param datetime.datetime latest_report_time: 数据库最新保存研报的发件时间
+        :param dict workers: 各阶段工作线程数, 默认为 PIPELINE_WORKERS
+        :param int queue_size: 各阶段输入队列长度
+        :param int queue_bytes: 各阶段输入队列中邮件、附件内容占用内存的上限(字节)
+        :param unverified: 预筛选时未经判断的邮件id(prefilter_ids 的 unverified_ids), 解析时需完整判断
+        """
+        self.db_manager = db_manager
+        self.writer = writer
+        self.latest_report_time = latest_report_time
+        self.unverified = unverified
+        workers = dict(PIPELINE_WORKERS, **(workers or {}))
+        self._local = threading.local()
+        self.pipeline = Pipeline([
+            Stage("fetch", self.fetch, workers["fetch"], queue_size, on_exit=self._logout),
+            Stage("parse", self.parse, workers["parse"], queue_size, queue_bytes=queue_bytes, sizeof=message_bytes),
+            Stage("extract", self.extract, workers["extract"], queue_size, queue_bytes=queue_bytes, sizeof=record_bytes,
+                  on_error=self.discard),
+            Stage("upload", self.upload, workers["upload"], queue_size, queue_bytes=queue_bytes, sizeof=record_bytes,
+                  on_error=self.discard),
+            Stage("db", self.save, workers["db"], queue_size, queue_bytes=queue_bytes, sizeof=record_bytes),
+        ])
+
+    def _session(self):
+        """ 下载线程各自使用一个IMAP连接 """
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = EmailInfoFetch(use_uid=SYNC_MODE == "uid", db_manager=self.db_manager)
+            session.login(EMAIL_USERNAME, EMAIL_PASSWORD)
+            session.inbox()
+            self._local.session = session
+        return session
+
+    def _logout(self):
+        session = getattr(self._local, "session", None)
+        if session is not None:
+            self._local.session = None
+            session.logout()
+
+    def fetch(self, ids, emit):
+        session = self._session()
+        messages = session.iter_email_parts(ids) if FETCH_MODE == "bodystructure" else session.iter_emails(ids)
+        for eid, message in messages:
+            # 下载前已按准入策略跳过的附件随邮件一起传递
+            emit((message, session.skipped_attachments, eid not in self.unverified))
+            session.clean_last_email_info()
+
+    def _parser(self):
+        """ 解析线程各自复用一个EmailInfoFetch, 每封邮件处理完后状态自动清空 """
+        parser = getattr(self._local, "parser", None)
+        if parser is None:
+            parser = EmailInfoFetch(db_manager=self.db_manager, defer_attachments=True)
+            parser.latest_report_time = self.latest_report_time
+            self._local.parser = parser
+        return parser
+
+    def parse(self, item, emit):
+        message, skipped_attachments, prefiltered = item
+        parser = self._parser()
+        parser.email_message = message
+        parser.skipped_attachments = skipped_attachments
+        with self.db_manager.connection():
+            record = parser.fetch_email_content(prefiltered=prefiltered)
+        if record is not None:
+            emit(record)
+
+    @staticmethod
+    def extract(record, emit):
+        emit(EmailInfoFetch.extract_pending_attachments(record))
+
+    @staticmethod
+    def upload(record, emit):
+        emit(EmailInfoFetch.upload_pending_attachments(record))
+
+    @staticmethod
+    def discard(record, err):
+        """ 解析、上传阶段处理失败的邮件不再保存, 释放其待处理附件(解析阶段失败时由 fetch_email_content 释放) """
+        EmailInfoFetch.discard_pending_attachments(record.pending_attachments, err)
+
+    def save(self, record, emit):
+        with self.db_manager.connection():
+            self.writer.add(record.to_data())
+
+    def run(self, ids, batch_size=FETCH_BATCH_SIZE):
+        """
+        抓取并保存邮件
+
+        :param list ids: 已通过预筛选的邮件id列表
+        :param int batch_size: 下载阶段每次处理的邮件数量
+        :return: 各阶段处理失败的总次数
+        :rtype: int
+        """
+        return self.pipeline.run(chunk_ids(ids, batch_size))
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+# ==============================================================================
+# @ Author :
+# @ Desc : 单封邮件的抓取结果
+# @ Date : 2021/6/26
+# ==============================================================================
+from typing import NamedTuple
+
+
+class EmailRecord(NamedTuple):
+    """
+    单封邮件的抓取结果(不可变), 由 EmailInfoFetch.fetch_email_content 返回;
+    流水线后续阶段通过 _replace 生成新的记录, 不修改原记录
+    """
+    subject: str
+    sender: str
+    sendtime: str
+    author: str
+    message_id: str
+    body: str
+    attachments: tuple = ()  # ((attach_uuid, attach_name, attach_size), ...)
+    attachment_text: str = ""
+    attachment_page: int = 0
+    skipped_attachments: tuple = ()  # ((附件名称, 原因), ...)
+    pending_attachments: tuple = ()  # 延后到流水线解析、上传阶段处理的附件, 见 EmailInfoFetch._admit_attach
+    uploads: tuple = ()  # 附件后台上传的 ((attach_uuid, Future), ...)
+
+    def drop_attachments(self, uuids, reason):
+        """
+        不收录指定的附件(如上传失败), 附件记入 skipped_attachments
+
+        :param uuids: 附件键集合
+        :param str reason: 不收录的原因
+        :return: 新的记录
+        :rtype: EmailRecord
+        """
+        dropped = [attach for attach in self.attachments if attach[0] in uuids]
+        if not dropped:
+            return self
+        return self._replace(
+            attachments=tuple(attach for attach in self.attachments if attach[0] not in uuids),
+            skipped_attachments=self.skipped_attachments + tuple((name, reason) for uuid, name, size in dropped),
+        )
+
+    def to_data(self):
+        """ 待保存的邮件信息(保存过程会修改该字典, 每次调用返回新的字典) """
+        return {
+            "subject": self.subject,
+            "sender": self.sender,
+            "body": self.body,
+            "datetime": self.sendtime,
+            "attachment_list": list(self.attachments),
+            "author": self.author,
+            "message_id": self.message_id,
+            "attachment_text": self.attachment_text,
+            "attachment_page": self.attachment_page,
+            "skipped_attachments": list(self.skipped_attachments)
+        }
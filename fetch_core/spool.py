@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+# ==============================================================================
+# @ Author :
+# @ Desc : 本地附件目录管理
+# @ Date : 2021/6/15
+# ==============================================================================
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from fetch_core.config import LOCAL_ATTACHMENT_ABSPATH, ATTACHMENT_SPOOL_QUOTA, ATTACHMENT_SPOOL_WAIT, \
+    ATTACHMENT_ORPHAN_AGE
+from utils.exceptions import SpoolQuotaException
+from utils.init_logger import get_logger
+
+logger = get_logger("spool")
+
+
+class SpoolScope:
+    """ 一次附件处理过程中写入的本地文件, 退出作用域时统一删除 """
+
+    def __init__(self, spool):
+        self.spool = spool
+        self.paths = []
+        self.pending = []  # (路径, 上传Future), 退出作用域且上传完成后才删除
+
+    def write(self, name, data):
+        path = self.spool.write(name, data)
+        self.paths.append(path)
+        return path
+
+    def release_after(self, path, future):
+        """ 文件在退出作用域且future完成(后台上传结束)后再删除 """
+        self.paths.remove(path)
+        self.pending.append((path, future))
+
+    def close(self):
+        while self.paths:
+            self.spool.release(self.paths.pop())
+        while self.pending:
+            path, future = self.pending.pop()
+            future.add_done_callback(lambda f, path=path: self.spool.release(path))
+
+
+class AttachmentSpool:
+    """
+    本地附件目录: 记录自己写入的文件并按路径直接删除, 启动时清理崩溃遗留的文件,
+    已占用空间超过配额时阻塞写入(背压), 直到其它附件被删除
+    """
+
+    def __init__(self, directory=LOCAL_ATTACHMENT_ABSPATH, quota=ATTACHMENT_SPOOL_QUOTA, wait=ATTACHMENT_SPOOL_WAIT):
+        self.directory = directory
+        self.quota = quota
+        self.wait = wait
+        os.makedirs(directory, exist_ok=True)
+        self._files = {}  # 路径 -> 文件大小
+        self._used = 0
+        self._cond = threading.Condition()
+
+    def sweep_orphans(self, older_than=ATTACHMENT_ORPHAN_AGE):
+        """
+        清理目录中不是本进程写入、且修改时间早于older_than秒前的遗留文件
+
+        :param int older_than: 文件最短存在时间, 避免误删其它抓取进程正在处理的附件
+        :return: 删除的文件数量
+        :rtype: int
+        """
+        deadline = time.time() - older_than
+        removed = 0
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if not entry.is_file() or entry.path in self._files:
+                    continue
+                try:
+                    if entry.stat().st_mtime < deadline:
+                        os.remove(entry.path)
+                        removed += 1
+                except FileNotFoundError:
+                    continue
+        if removed:
+            logger.info(f"清理本地附件目录遗留文件 {removed} 个")
+        return removed
+
+    def write(self, name, data):
+        """
+        写入附件, 配额不足时等待; 目录中没有本进程的文件时即使超过配额也允许写入, 避免单个大附件永远等待
+
+        :param str name: 文件名
+        :param bytes data: 附件内容
+        :return: 文件绝对路径
+        :rtype: str
+        """
+        size = len(data)
+        path = os.path.join(self.directory, name)
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._used + size <= self.quota or not self._files, self.wait):
+                raise SpoolQuotaException(f"已占用{self._used}字节, 配额{self.quota}字节, 附件[{name}]{size}字节")
+            self._files[path] = size
+            self._used += size
+        try:
+            with open(path, "wb") as f:
+                f.write(data)
+        except Exception:
+            self._forget(path)
+            raise
+        return path
+
+    def release(self, path):
+        """ 按路径删除附件 """
+        try:
+            os.remove(path)
+            logger.info(f"本地删除附件[{os.path.basename(path)}]成功")
+        except FileNotFoundError:
+            pass
+        self._forget(path)
+
+    def _forget(self, path):
+        with self._cond:
+            self._used -= self._files.pop(path, 0)
+            self._cond.notify_all()
+
+    @contextmanager
+    def scope(self):
+        """
+        附件处理作用域, 退出时删除作用域内写入的所有文件
+
+            with attachment_spool.scope() as scope:
+                path = scope.write(name, data)
+        """
+        scope = SpoolScope(self)
+        try:
+            yield scope
+        finally:
+            scope.close()
+
+
+attachment_spool = AttachmentSpool()
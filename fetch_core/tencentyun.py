@@ -4,10 +4,12 @@
 # @ Desc : 附件上传腾讯云
 # @ Date : 2021/4/26
 # ==============================================================================
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 from qcloud_cos import CosConfig, CosS3Client
 
-from fetch_core.config import TENCENTCLOUD_CONFIG, LOCAL_ATTACHMENT_ABSPATH
+from fetch_core.config import TENCENTCLOUD_CONFIG, LOCAL_ATTACHMENT_ABSPATH, COS_UPLOAD_WORKERS, COS_UPLOAD_QUEUE_SIZE
 from utils.init_logger import get_logger
 from utils.data_processing import etag_rm_quotation
 
@@ -67,8 +69,7 @@ class TencentCloud:
         :return: 上传对象的属性
         :rtype: dict
         """
-        client = self.cos_client()
-        response = client.upload_file(
+        response = self.client.upload_file(
             Bucket=bucket,
             LocalFilePath=local_file_path,
             Key=file_name,
@@ -78,6 +79,23 @@ class TencentCloud:
         )
         return response["ETag"]
 
+    def attach_put(self, bucket, file_name, body):
+        """
+        从内存上传附件(简单上传, 不经过本地文件)
+
+        :param bucket: 存储桶名称，由 BucketName-APPID 构成
+        :param file_name: 对象键（Key），对象在存储桶中的唯一标识
+        :param body: 附件内容, bytes 或 file-like 对象
+        :return: 上传对象的ETag
+        :rtype: str
+        """
+        response = self.client.put_object(
+            Bucket=bucket,
+            Body=body,
+            Key=file_name
+        )
+        return response["ETag"]
+
     def delete_object(self, bucket, key):
         """
         删除附件
@@ -99,10 +117,92 @@ class TencentCloud:
         :return:
         """
         file_path = LOCAL_ATTACHMENT_ABSPATH + file_type
-        self.cos_client().download_file(Bucket=bucket, Key=key, DestFilePath=file_path)
+        self.client.download_file(Bucket=bucket, Key=key, DestFilePath=file_path)
 
 
-def upload_with_cos(file_name, file_dir_path=None, part_size=3, max_thread=5):
+class CosUploader:
+    """
+    后台上传队列: 整个进程共用一个cos客户端, 上传在线程池中进行, 不阻塞邮件的下载和解析;
+    排队中的上传数量达到上限时submit阻塞(背压), 避免待上传的附件占用过多内存
+    """
+
+    def __init__(self, max_workers=COS_UPLOAD_WORKERS, queue_size=COS_UPLOAD_QUEUE_SIZE):
+        self.max_workers = max_workers
+        self._cloud = None
+        self._executor = None
+        self._slots = threading.BoundedSemaphore(queue_size)
+        self._lock = threading.Lock()
+
+    @property
+    def cloud(self):
+        """ 第一次使用时才创建客户端, 所有上传共用 """
+        if self._cloud is None:
+            with self._lock:
+                if self._cloud is None:
+                    self._cloud = TencentCloud()
+        return self._cloud
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="cos-upload")
+            return self._executor
+
+    def upload(self, file_name, local_file_path=None, body=None, part_size=3, max_thread=5):
+        """
+        上传附件, body不为None时从内存上传, 否则上传本地文件
+
+        :return: 去掉引号的etag
+        :rtype: str
+        """
+        if body is not None:
+            etag = self.cloud.attach_put(
+                bucket=TENCENTCLOUD_CONFIG["BUCKET_NAME"],
+                file_name=file_name,
+                body=body
+            )
+        else:
+            etag = self.cloud.attach_upload(
+                bucket=TENCENTCLOUD_CONFIG["BUCKET_NAME"],
+                file_name=file_name,
+                local_file_path=local_file_path,
+                part_size=part_size,
+                max_thread=max_thread
+            )
+        logger.info(f"附件[{file_name}]上传至腾讯云成功，返回ETag:{etag}")
+        return etag_rm_quotation(etag)
+
+    def submit(self, file_name, local_file_path=None, body=None):
+        """
+        提交后台上传, 队列已满时等待
+
+        :param str file_name: 对象键(uuid+文件类型)
+        :param str local_file_path: 本地文件路径, 上传完成前不能删除
+        :param body: 内存中的附件内容(bytes 或 file-like)
+        :return: Future, 结果为上传成功返回的etag, 上传失败时抛出异常
+        :rtype: concurrent.futures.Future
+        """
+        self._slots.acquire()
+        try:
+            future = self._get_executor().submit(self.upload, file_name, local_file_path, body)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda f: self._slots.release())
+        return future
+
+    def shutdown(self, wait=True):
+        """ 等待已提交的上传完成并关闭线程池 """
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait)
+
+
+cos_uploader = CosUploader()
+
+
+def upload_with_cos(file_name, file_dir_path=None, part_size=3, max_thread=5, body=None):
     """
     附件上传腾讯云
 
@@ -110,6 +210,7 @@ def upload_with_cos(file_name, file_dir_path=None, part_size=3, max_thread=5):
     :param str file_dir_path: 上传附件目录的绝对路径
     :param int part_size: 分块上传的分块大小，默认为3MB，单位为MB
     :param int max_thread: 分块上传的并发数量，默认为5个线程上传分块
+    :param body: 内存中的附件内容(bytes 或 file-like), 不为None时直接从内存上传, 忽略本地路径
     :return: 上传腾讯云成功返回的etag
     :rtype: str
     """
@@ -119,14 +220,7 @@ def upload_with_cos(file_name, file_dir_path=None, part_size=3, max_thread=5):
         file_path = file_dir_path + file_name
 
     try:
-        etag = TencentCloud().attach_upload(
-            bucket=TENCENTCLOUD_CONFIG["BUCKET_NAME"],
-            file_name=file_name,
-            local_file_path=file_path,
-            part_size=part_size,
-            max_thread=max_thread
-        )
-        logger.info(f"附件[{file_name}]上传至腾讯云成功，返回ETag:{etag}")
-        return etag_rm_quotation(etag)
+        return cos_uploader.upload(file_name, local_file_path=file_path, body=body,
+                                   part_size=part_size, max_thread=max_thread)
     except Exception as err:
         logger.error(f"附件[{file_name}]上传至腾讯云失败！！错误信息: {err}")
@@ -6,41 +6,54 @@
 # ==============================================================================
 import datetime
 
-from fetch_core.config import EMAIL_USERNAME, EMAIL_PASSWORD
-from fetch_core.db import DBManagement
+from fetch_core.checkpoint import SyncCheckpoint
+from fetch_core.config import EMAIL_USERNAME, EMAIL_PASSWORD, SYNC_MODE
+from fetch_core.db import DBManagement, ReportBatchWriter, attachment_index
+from fetch_core.extractor import extractor_pool
 from fetch_core.outlook import EmailInfoFetch
+from fetch_core.pipeline import EmailPipeline
+from fetch_core.spool import attachment_spool
+from fetch_core.tencentyun import cos_uploader
+from utils.es_tokenizer import es_tokenizer
 
 
 def run_email_fetch():
     start_time = datetime.datetime.now()
-    outlook = EmailInfoFetch()
+    # 清理上次运行遗留的本地附件
+    attachment_spool.sweep_orphans()
+    db_manager = DBManagement()
+    outlook = EmailInfoFetch(use_uid=SYNC_MODE == "uid", db_manager=db_manager)
     # 登录邮箱
     outlook.login(EMAIL_USERNAME, EMAIL_PASSWORD)
     # 进入 Inbox
     outlook.inbox()
-    # 获取最新保存研报的发件时间
-    latest_report_time = DBManagement().get_latest_report_time()
-    # 获取上次保存研报时间到现在所有邮件
-    ids = outlook.all_ids_since_date(latest_report_time)
-
-    for eid in ids:
-        outlook.get_email(eid.decode())
+    # 获取上次同步断点(或上次保存研报时间)之后的所有邮件
+    checkpoint = SyncCheckpoint()
+    all_ids = outlook.pending_ids(checkpoint)
+    # 只下载邮件头预筛选，过滤掉无需抓取的邮件
+    ids = outlook.prefilter_ids(all_ids)
+    # 登出, 下载由流水线的下载阶段使用各自的连接进行
+    outlook.logout()
 
-        # 抓取前判断是否满足抓取需要
-        if not outlook.fetch_email_content():
-            outlook.clean_last_email_info()
-            continue
+    # 流水线下载、解析、上传并批量保存
+    with ReportBatchWriter(db_manager) as writer:
+        pipeline = EmailPipeline(db_manager, writer, outlook.latest_report_time, unverified=outlook.unverified_ids)
+        errors = pipeline.run(ids)
 
-        # 保存邮件内容
-        outlook.save_email()
-        # 内存清理上一封邮件信息
-        outlook.clean_last_email_info()
+    # 全部处理成功才保存同步断点, 否则下次运行重新处理
+    if outlook.use_uid and all_ids and not errors and not writer.failed:
+        checkpoint.save(outlook.folder, outlook.uid_validity, max(int(uid) for uid in all_ids))
 
-        # 登出
-    outlook.logout()
+    es_tokenizer.log_stats()
+    attachment_index.log_stats()
     end_time = datetime.datetime.now()
-    print("此次邮件抓取共耗时: {}".format(end_time - start_time))
+    print("此次邮件抓取共保存 {} 封, 共耗时: {}".format(writer.saved, end_time - start_time))
 
 
 if __name__ == '__main__':
-    run_email_fetch()
+    try:
+        run_email_fetch()
+    finally:
+        # 等待后台上传完成并关闭上传线程池, 结束附件解析进程
+        cos_uploader.shutdown()
+        extractor_pool.shutdown()
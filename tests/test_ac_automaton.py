@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+# ==============================================================================
+# @ Author :
+# @ Desc : Aho-Corasick多模式匹配自动机测试
+# @ Date : 2021/6/10
+# ==============================================================================
+import unittest
+
+from utils.ac_automaton import ACAutomaton
+
+
+def make_automaton(*patterns):
+    automaton = ACAutomaton()
+    for value, pattern in enumerate(patterns, 1):
+        automaton.add(pattern, value)
+    automaton.build()
+    return automaton
+
+
+class ACAutomatonTest(unittest.TestCase):
+
+    def test_all_matches_include_overlaps(self):
+        automaton = make_automaton("he", "she", "his", "hers")
+        self.assertEqual(sorted(automaton.iter_matches("ushers")), [(1, 4, 2), (2, 4, 1), (2, 6, 4)])
+
+    def test_longest_leftmost_without_overlap(self):
+        automaton = make_automaton("平安", "中国平安", "平安银行", "银行")
+        self.assertEqual(automaton.find_longest("中国平安与平安银行点评"), [(0, 4, 2), (5, 9, 3)])
+
+    def test_no_match_and_empty_text(self):
+        automaton = make_automaton("平安银行")
+        self.assertEqual(automaton.find_longest("招商银行"), [])
+        self.assertEqual(automaton.find_longest(""), [])
+
+    def test_duplicate_pattern_keeps_first_value(self):
+        automaton = ACAutomaton()
+        automaton.add("万科A", 1)
+        automaton.add("万科A", 2)
+        automaton.add("", 3)
+        self.assertEqual(len(automaton), 1)
+        self.assertEqual(automaton.find_longest("万科A年报"), [(0, 3, 1)])
+
+    def test_add_after_build_rebuilds(self):
+        automaton = make_automaton("平安")
+        automaton.add("招商", 9)
+        self.assertEqual(automaton.find_longest("招商平安"), [(0, 2, 9), (2, 4, 1)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+# ==============================================================================
+# @ Author :
+# @ Desc : asyncio抓取引擎测试(本地asyncio IMAP模拟服务端)
+# @ Date : 2021/6/8
+# ==============================================================================
+import asyncio
+import datetime
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+import aio_run
+from fetch_core.aio_outlook import AsyncEmailInfoFetch
+from fetch_core.config import FETCH_BATCH_SIZE
+from utils.exceptions import IMAPCommandException
+
+
+def make_message(index):
+    return (
+        "Date: Mon, 7 Jun 2021 10:0{0}:00 +0800\r\n"
+        "From: broker <r@a.com>\r\n"
+        "Subject: s{0}\r\n"
+        "\r\n"
+        "body {0}\r\n".format(index)
+    ).encode()
+
+
+class FakeIMAPServer:
+    """ 本地IMAP模拟服务端: 支持 LOGIN/SELECT/SEARCH/FETCH(含UID)/CLOSE/LOGOUT, 邮件序号1~n, UID为序号+10 """
+
+    def __init__(self, count=7, failing=(), dropping=()):
+        self.messages = {seq: make_message(seq) for seq in range(1, count + 1)}
+        self.failing = set(failing)  # FETCH包含这些序号时返回NO
+        self.dropping = set(dropping)  # FETCH包含这些序号时断开连接
+        self.commands = []
+        self.server = None
+        self.port = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, "127.0.0.1", 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    @staticmethod
+    def _parse_set(message_set):
+        numbers = []
+        for part in message_set.split(","):
+            start, _, end = part.partition(":")
+            numbers.extend(range(int(start), int(end or start) + 1))
+        return numbers
+
+    def _fetch(self, tag, args, uid):
+        message_set, _, query = args.partition(" ")
+        seqs = [number - 10 if uid else number for number in self._parse_set(message_set)]
+        if self.failing.intersection(seqs):
+            return "{} NO fetch failed\r\n".format(tag).encode()
+        out = b""
+        for seq in seqs:
+            raw = self.messages[seq]
+            if "HEADER" in query:
+                header = raw.split(b"\r\n\r\n")[0] + b"\r\n\r\n"
+                out += "* {} FETCH (UID {} RFC822.SIZE {} BODY[HEADER.FIELDS (DATE)] {{{}}}\r\n".format(
+                    seq, seq + 10, len(raw), len(header)).encode() + header + b")\r\n"
+            else:
+                out += "* {} FETCH (UID {} RFC822 {{{}}}\r\n".format(seq, seq + 10, len(raw)).encode() + raw + b")\r\n"
+        return out + "{} OK FETCH completed\r\n".format(tag).encode()
+
+    async def handle(self, reader, writer):
+        writer.write(b"* OK IMAP4rev1 ready\r\n")
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            tag, command, *rest = line.decode().rstrip("\r\n").split(" ", 2)
+            args = rest[0] if rest else ""
+            uid = command == "UID"
+            if uid:
+                command, _, args = args.partition(" ")
+            self.commands.append(command)
+            if command == "SELECT":
+                out = "* {} EXISTS\r\n* OK [UIDVALIDITY 55] UIDs valid\r\n{} OK [READ-WRITE] done\r\n".format(
+                    len(self.messages), tag).encode()
+            elif command == "SEARCH":
+                ids = " ".join(str(seq + 10 if uid else seq) for seq in self.messages)
+                out = "* SEARCH {}\r\n{} OK SEARCH completed\r\n".format(ids, tag).encode()
+            elif command == "FETCH":
+                # 模拟网络延迟, 使多条FETCH同时在途
+                await asyncio.sleep(0.01)
+                message_set = args.partition(" ")[0]
+                if self.dropping.intersection(self._parse_set(message_set)):
+                    writer.close()
+                    return
+                out = self._fetch(tag, args, uid)
+            elif command == "LOGOUT":
+                writer.write("* BYE logging out\r\n{} OK LOGOUT completed\r\n".format(tag).encode())
+                await writer.drain()
+                writer.close()
+                return
+            else:
+                out = "{} OK {} completed\r\n".format(tag, command).encode()
+            writer.write(out)
+            await writer.drain()
+
+
+class AsyncEmailInfoFetchTest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.server = FakeIMAPServer()
+        await self.server.start()
+
+    async def asyncTearDown(self):
+        await self.server.stop()
+
+    async def open_session(self, use_uid=False):
+        session = AsyncEmailInfoFetch("127.0.0.1", self.server.port, use_ssl=False, use_uid=use_uid)
+        await session.login("user", "password")
+        await session.inbox()
+        return session
+
+    async def test_fetch_by_sequence_number(self):
+        session = await self.open_session()
+        self.assertEqual(session.uid_validity, 55)
+        ids = await session.all_ids_since_date(datetime.datetime(2021, 6, 1))
+        self.assertEqual(ids, [str(seq).encode() for seq in range(1, 8)])
+
+        headers = await session.get_headers(ids, batch_size=3)
+        self.assertEqual(sorted(headers), [str(seq) for seq in range(1, 8)])
+        self.assertEqual(session.email_sizes["3"], len(make_message(3)))
+
+        fetched = [(eid, message["Subject"]) async for eid, message in session.iter_emails(ids, batch_size=2)]
+        self.assertEqual(fetched, [(str(seq), "s{}".format(seq)) for seq in range(1, 8)])
+        await session.logout()
+
+    async def test_fetch_by_uid(self):
+        session = await self.open_session(use_uid=True)
+        self.assertEqual(await session.all_uids_after(15), [b"16", b"17"])
+        fetched = [eid async for eid, message in session.iter_emails([b"16", b"17"], batch_size=1)]
+        self.assertEqual(fetched, ["16", "17"])
+        await session.logout()
+
+    async def test_pipelined_fetch_keeps_order(self):
+        session = await self.open_session()
+        ids = [str(seq).encode() for seq in range(1, 8)]
+        # 每批一封, 多条FETCH同时在途时仍按发送顺序返回
+        fetched = [eid async for eid, message in session.iter_emails(ids, batch_size=1, byte_budget=None)]
+        self.assertEqual(fetched, [str(seq) for seq in range(1, 8)])
+        await session.logout()
+
+    async def test_failed_batch_raises_after_other_batches(self):
+        self.server.failing = {3}
+        session = await self.open_session()
+        ids = [str(seq).encode() for seq in range(1, 8)]
+        fetched = []
+        with self.assertRaises(IMAPCommandException):
+            async for eid, message in session.iter_emails(ids, batch_size=2, byte_budget=None):
+                fetched.append(eid)
+        self.assertEqual(fetched, ["1", "2", "5", "6", "7"])
+        await session.logout()
+
+    async def test_logout_after_connection_dropped(self):
+        self.server.dropping = {3}
+        session = await self.open_session()
+        ids = [str(seq).encode() for seq in range(1, 8)]
+        with self.assertRaises(IMAPCommandException):
+            async for eid, message in session.iter_emails(ids, batch_size=2, byte_budget=None):
+                pass
+        with self.assertRaises(IMAPCommandException):
+            await session.inbox()
+        # 连接已断开时登出不再等待永远不会到达的响应
+        await asyncio.wait_for(session.logout(), timeout=1)
+        self.assertTrue(session.writer.is_closing())
+
+
+class FetchWorkerTest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.lock = threading.Lock()
+        self.state = {"running": 0, "max_running": 0, "saved": 0}
+        self.original, aio_run.save_message = aio_run.save_message, self.slow_save
+
+    async def asyncTearDown(self):
+        aio_run.save_message = self.original
+
+    def slow_save(self, message, latest_report_time, writer, db_manager, prefiltered=True):
+        with self.lock:
+            self.state["running"] += 1
+            self.state["max_running"] = max(self.state["max_running"], self.state["running"])
+        time.sleep(0.02)
+        with self.lock:
+            self.state["running"] -= 1
+            self.state["saved"] += 1
+        return True
+
+    async def run_worker(self, server, max_pending):
+        await server.start()
+        try:
+            session = AsyncEmailInfoFetch("127.0.0.1", server.port, use_ssl=False)
+            await session.login("user", "password")
+            await session.inbox()
+            ids = [str(seq).encode() for seq in server.messages]
+            with ThreadPoolExecutor(max_workers=8) as executor:
+                return await aio_run.fetch_worker(session, ids, None, executor, None, None, max_pending=max_pending)
+        finally:
+            await server.stop()
+
+    async def test_pending_saves_are_bounded(self):
+        fetched = await self.run_worker(FakeIMAPServer(count=9), max_pending=2)
+        self.assertEqual(fetched, 9)
+        self.assertLessEqual(self.state["max_running"], 2)
+
+    async def test_failed_fetch_waits_for_submitted_saves(self):
+        # 第一批(FETCH_BATCH_SIZE封)成功, 第二批失败
+        count = FETCH_BATCH_SIZE + 1
+        with self.assertRaises(IMAPCommandException):
+            await self.run_worker(FakeIMAPServer(count=count, failing={count}), max_pending=count)
+        # 抛出异常时已提交的保存全部完成, 调用方随后flush不会与保存并发
+        self.assertEqual(self.state["running"], 0)
+        self.assertEqual(self.state["saved"], FETCH_BATCH_SIZE)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+# ==============================================================================
+# @ Author :
+# @ Desc : 邮件正文解码测试
+# @ Date : 2021/6/23
+# ==============================================================================
+import unittest
+
+from fetch_core.charset import BodyDecoder
+
+TEXT = "研报点评: 平安银行 㐀"
+
+
+class BodyDecoderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.decoder = BodyDecoder()
+
+    def test_declared_charset(self):
+        self.assertEqual(self.decoder.decode(TEXT.encode("gb18030"), "gb2312"), TEXT)
+        self.assertEqual(self.decoder.decode(TEXT.encode("big5", errors="ignore"), "big5"),
+                         TEXT.encode("big5", errors="ignore").decode("big5"))
+
+    def test_declared_gb2312_but_utf8(self):
+        # GB18030 能解码这些UTF-8字节, 但结果是乱码
+        payload = TEXT.encode("utf-8")
+        self.assertNotEqual(payload.decode("gb18030", errors="ignore"), TEXT)
+        self.assertEqual(self.decoder.decode(payload, "gb2312", "a.com"), TEXT)
+
+    def test_declared_ascii_but_gb18030(self):
+        self.assertEqual(self.decoder.decode(TEXT.encode("gb18030"), "us-ascii", "a.com"), TEXT)
+
+    def test_undeclared_and_unknown_charset(self):
+        self.assertEqual(self.decoder.decode(TEXT.encode("gb18030")), TEXT)
+        self.assertEqual(self.decoder.decode(TEXT.encode("gb18030"), "x-unknown"), TEXT)
+        self.assertEqual(self.decoder.decode("é".encode("latin-1")), "é")
+        self.assertEqual(self.decoder.decode(b""), "")
+        self.assertEqual(self.decoder.decode(None), "")
+
+    def test_utf16_declared_before_utf8(self):
+        self.assertEqual(self.decoder.decode("ab".encode("utf-16-le"), "utf-16-le"), "ab")
+
+    def test_remembers_working_charset_for_wrong_declaration(self):
+        self.decoder.decode(TEXT.encode("gb18030"), "us-ascii", "a.com")
+        self.assertEqual(self.decoder._candidates("ascii", "a.com")[:3], ["utf-8", "gb18030", "ascii"])
+        # 其它机构、其它声明不受影响
+        self.assertEqual(self.decoder._candidates("ascii", "b.com")[:2], ["utf-8", "ascii"])
+        self.assertEqual(self.decoder._candidates("big5", "a.com")[:2], ["utf-8", "big5"])
+        # 记住字符集后UTF-8正文仍正确解码
+        self.assertEqual(self.decoder.decode(TEXT.encode("utf-8"), "us-ascii", "a.com"), TEXT)
+
+    def test_forgets_when_declared_charset_works_again(self):
+        self.decoder._domains[("a.com", "big5")] = "ascii"
+        payload = "平安銀行".encode("big5")
+        self.assertEqual(self.decoder.decode(payload, "big5", "a.com"), "平安銀行")
+        self.assertEqual(self.decoder._domains, {})
+
+    def test_last_fallback_is_not_remembered(self):
+        self.decoder.decode(b"\xff\xfe\x81", "us-ascii", "a.com")
+        self.assertEqual(self.decoder._domains, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+# ==============================================================================
+# @ Author :
+# @ Desc : UID增量同步断点测试
+# @ Date : 2021/6/3
+# ==============================================================================
+import datetime
+import os
+import tempfile
+import unittest
+
+from fetch_core.checkpoint import SyncCheckpoint
+from fetch_core.outlook import EmailInfoFetch
+
+
+class SyncCheckpointTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "sync_checkpoint.json")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_missing_file_has_no_checkpoint(self):
+        self.assertEqual(SyncCheckpoint(self.path).load("INBOX"), (None, 0))
+
+    def test_save_and_load_per_folder(self):
+        checkpoint = SyncCheckpoint(self.path)
+        checkpoint.save("INBOX", 55, 120)
+        checkpoint.save("Archive", 7, 3)
+        checkpoint = SyncCheckpoint(self.path)
+        self.assertEqual(checkpoint.load("INBOX"), (55, 120))
+        self.assertEqual(checkpoint.load("Archive"), (7, 3))
+        self.assertFalse(os.path.exists(self.path + ".tmp"))
+
+    def test_corrupt_file_falls_back_to_date_scan(self):
+        with open(self.path, "w", encoding="utf-8") as f:
+            f.write("{")
+        self.assertEqual(SyncCheckpoint(self.path).load("INBOX"), (None, 0))
+
+
+class IncrementalIdsTest(unittest.TestCase):
+    """ 增量同步以UID范围为准, 只有按日期扫描时才按发件时间过滤 """
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.checkpoint = SyncCheckpoint(os.path.join(self.directory.name, "sync_checkpoint.json"))
+        self.checkpoint.save("INBOX", 55, 10)
+        self.latest_report_time = datetime.datetime(2021, 6, 7, 10, 0, 0)
+        self.outlook = EmailInfoFetch(use_uid=True)
+        self.outlook.folder = "INBOX"
+        self.outlook.all_uids_after = lambda last_uid: [b"11", b"12"]
+        self.outlook.all_ids_since_date = self.fake_date_scan
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def fake_date_scan(self, date_time):
+        self.outlook.latest_report_time = date_time
+        return [b"1"]
+
+    def test_valid_checkpoint_skips_send_time_cutoff(self):
+        self.outlook.uid_validity = 55
+        self.assertEqual(self.outlook.incremental_ids(self.checkpoint, self.latest_report_time), [b"11", b"12"])
+        # 断点未推进时重新处理的邮件可能早于数据库最新研报
+        self.outlook.sendtime = "2021-06-01 09:00:00"
+        self.assertFalse(self.outlook.if_earlier_than_report_time())
+
+    def test_changed_uid_validity_keeps_send_time_cutoff(self):
+        self.outlook.uid_validity = 56
+        self.assertEqual(self.outlook.incremental_ids(self.checkpoint, self.latest_report_time), [b"1"])
+        self.outlook.sendtime = "2021-06-01 09:00:00"
+        self.assertTrue(self.outlook.if_earlier_than_report_time())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+# ==============================================================================
+# @ Author :
+# @ Desc : 批量保存测试(SQLite内存数据库代替MySQL)
+# @ Date : 2021/6/9
+# ==============================================================================
+import unittest
+
+from peewee import SqliteDatabase
+
+from fetch_core import db
+from fetch_core.db import DBManagement, ReportBatchWriter, StockTagger, TReport, TReportContent, TTag, \
+    TAttachment, TReportOtherUser, subject_index, stock_tagger
+
+MODELS = [TReport, TReportContent, TTag, TAttachment, TReportOtherUser]
+
+
+def make_data(index, message_id=None, attachments=()):
+    return {
+        "subject": "平安银行点评{}".format(index),
+        "sender": "r@a.com",
+        "body": "<p>正文{}</p>".format(index),
+        "datetime": "2021-06-07 10:00:00",
+        "attachment_list": list(attachments),
+        "author": "券商A",
+        "attachment_text": "",
+        "attachment_page": 0,
+        "message_id": message_id or "<{}@a.com>".format(index),
+    }
+
+
+class DBTestCase(unittest.TestCase):
+    """ 各测试使用独立的内存数据库, 模块级索引重置为空 """
+
+    def setUp(self):
+        self.database = SqliteDatabase(":memory:")
+        self.database.bind(MODELS)
+        # 只建表测试用到的字段, 其余字段允许为空
+        nullable = [field for model in MODELS for field in model._meta.fields.values()
+                    if not field.null and field.name != "id"]
+        for field in nullable:
+            field.null = True
+        try:
+            self.database.create_tables(MODELS)
+        finally:
+            for field in nullable:
+                field.null = False
+        self.original_db, db.db_mysql = db.db_mysql, self.database
+        TTag.create(type_id=4, name="平安银行", stock_name="平安银行")
+        subject_index._digests = set()
+        stock_tagger._automaton = None
+
+    def tearDown(self):
+        db.db_mysql = self.original_db
+        subject_index._digests = None
+        stock_tagger._automaton = None
+        self.database.close()
+
+
+class SaveEmailsTest(DBTestCase):
+
+    def test_batch_save(self):
+        saved = DBManagement().save_emails_to_mysql(
+            [make_data(1, attachments=[("u1.pdf", "a.pdf", 3)]), make_data(2)])
+        self.assertEqual(saved, 2)
+        reports = {report.name: report for report in TReport.select()}
+        self.assertEqual(len(reports), 2)
+        self.assertEqual(TReportContent.select().count(), 2)
+        report = reports["平安银行点评1"]
+        self.assertEqual(TReportContent.get_by_id(report.content_id).report_id, report.id)
+
+    def test_same_message_id_in_one_batch(self):
+        # 同一封邮件投递到两个别名, 标题不同但研报唯一键相同
+        saved = DBManagement().save_emails_to_mysql([
+            make_data(1, message_id="<same@a.com>"),
+            make_data(2, message_id="<same@a.com>", attachments=[("u2.pdf", "b.pdf", 3)]),
+        ])
+        self.assertEqual(saved, 1)
+        self.assertEqual(TReport.select().count(), 1)
+        self.assertEqual(TReportContent.select().count(), 1)
+        self.assertEqual(TAttachment.select().count(), 0)
+        self.assertFalse(subject_index.contains("平安银行点评2"))
+
+    def test_duplicate_subject_is_skipped(self):
+        manager = DBManagement()
+        self.assertEqual(manager.save_emails_to_mysql([make_data(1)]), 1)
+        data = make_data(1, message_id="<other@a.com>")
+        self.assertEqual(manager.save_emails_to_mysql([data]), 0)
+
+
+class ReportBatchWriterTest(DBTestCase):
+
+    def test_failed_batch_is_retried_one_by_one(self):
+        writer = ReportBatchWriter(DBManagement(), batch_size=3)
+        writer.add(make_data(1))
+        # 无法写入的附件大小使整批失败
+        writer.add(make_data(2, attachments=[("u2.pdf", "b.pdf", object())]))
+        writer.add(make_data(3))
+        self.assertEqual((writer.saved, writer.failed), (2, 1))
+        self.assertEqual(sorted(report.name for report in TReport.select()), ["平安银行点评1", "平安银行点评3"])
+        # 失败的研报释放了标题, 之后可以重新保存
+        writer.add(make_data(2))
+        writer.flush()
+        self.assertEqual((writer.saved, writer.failed), (3, 1))
+
+    def test_flush_writes_remaining(self):
+        with ReportBatchWriter(DBManagement(), batch_size=10) as writer:
+            writer.add(make_data(1))
+            self.assertEqual(writer.saved, 0)
+        self.assertEqual(writer.saved, 1)
+        self.assertEqual(TReport.get().tag_id_list, str([TTag.get().id]))
+
+
+
+class StockTaggerTest(DBTestCase):
+
+    def test_match_and_reload_renamed_stock(self):
+        tagger = StockTagger(ttl=0)
+        bank = TTag.get()
+        insurer = TTag.create(type_id=4, name="中国平安", stock_name="中国平安")
+        self.assertEqual(tagger.match("中国平安与平安银行点评"), [insurer.id, bank.id])
+        # 行数和最大id不变, 只修改名称
+        TTag.update(stock_name="平安保险").where(TTag.id == insurer.id).execute()
+        self.assertEqual(tagger.match("中国平安与平安保险点评"), [insurer.id])
+
+    def test_reload_only_after_ttl(self):
+        tagger = StockTagger(ttl=3600)
+        tag_id = TTag.get().id
+        self.assertEqual(tagger.match("平安银行"), [tag_id])
+        # TTL内不重新读取 t_tag
+        TTag.delete().execute()
+        self.assertEqual(tagger.match("平安银行"), [tag_id])
+        tagger.ttl = 0
+        self.assertEqual(tagger.match("平安银行"), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
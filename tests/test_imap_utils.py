@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+# ==============================================================================
+# @ Author :
+# @ Desc : IMAP协议工具测试
+# @ Date : 2021/6/2
+# ==============================================================================
+import base64
+import unittest
+
+from utils.imap_utils import parse_fetch_response, compress_id_set, chunk_ids, parse_fetch_items, \
+    parse_bodystructure, iter_body_parts, build_message
+
+HEADER = b"Subject: forwarded\r\nFrom: r@a.com\r\n\r\n"
+# 正文(html) + pdf附件 + 转发的邮件(内含纯文本正文)
+BODYSTRUCTURE = (
+    b'(("TEXT" "HTML" ("CHARSET" "utf-8") NIL NIL "BASE64" 24 1 NIL NIL NIL NIL)'
+    b'("APPLICATION" "PDF" ("NAME" "a.pdf") NIL NIL "BASE64" 8 NIL ("ATTACHMENT" ("FILENAME" "a.pdf")) NIL NIL)'
+    b'("MESSAGE" "RFC822" NIL NIL NIL "7BIT" 100 ("date" "subj" NIL NIL NIL NIL NIL NIL NIL "<m@x>")'
+    b' ("TEXT" "PLAIN" ("CHARSET" "utf-8") NIL NIL "7BIT" 5 1 NIL NIL NIL NIL) 3 NIL NIL NIL NIL)'
+    b' "MIXED" ("BOUNDARY" "b") NIL NIL NIL)'
+)
+
+
+class CompressIdSetTest(unittest.TestCase):
+
+    def test_ranges(self):
+        self.assertEqual(compress_id_set([b"1", b"2", b"3", b"5", b"7", b"8"]), "1:3,5,7:8")
+
+    def test_unsorted_duplicated_mixed_types(self):
+        self.assertEqual(compress_id_set([9, "3", b"4", 3, b"10"]), "3:4,9:10")
+
+    def test_single_and_empty(self):
+        self.assertEqual(compress_id_set([b"42"]), "42")
+        self.assertEqual(compress_id_set([]), "")
+
+
+class ChunkIdsTest(unittest.TestCase):
+
+    def test_batch_size(self):
+        self.assertEqual(chunk_ids([1, 2, 3, 4, 5], 2), [[1, 2], [3, 4], [5]])
+        self.assertEqual(chunk_ids([], 2), [])
+
+    def test_byte_budget(self):
+        sizes = {"1": 40, "2": 40, "3": 40, "4": 10}
+        self.assertEqual(chunk_ids([b"1", b"2", b"3", b"4"], 10, 100, sizes), [[b"1", b"2"], [b"3", b"4"]])
+
+    def test_oversized_message_is_its_own_batch(self):
+        sizes = {"1": 10, "2": 500, "3": 10}
+        self.assertEqual(chunk_ids(["1", "2", "3"], 10, 100, sizes), [["1"], ["2"], ["3"]])
+
+    def test_unknown_sizes_count_as_zero(self):
+        self.assertEqual(chunk_ids([1, 2, 3], 10, 1, {}), [[1, 2, 3]])
+
+
+class ParseFetchResponseTest(unittest.TestCase):
+
+    def test_literals_and_trailing_uid(self):
+        data = [
+            (b"1 (UID 11 RFC822.SIZE 5 RFC822 {5}", b"hello"),
+            b")",
+            (b"2 (RFC822 {3}", b"abc"),
+            b" UID 12)",
+        ]
+        self.assertEqual(parse_fetch_response(data), [
+            {"seq": 1, "uid": 11, "size": 5, "literal": b"hello"},
+            {"seq": 2, "uid": 12, "size": None, "literal": b"abc"},
+        ])
+
+    def test_size_only_response(self):
+        data = [b"3 (UID 13 RFC822.SIZE 2048)", None, b"4 (UID 14 RFC822.SIZE 10)"]
+        self.assertEqual([(item["uid"], item["size"], item["literal"]) for item in parse_fetch_response(data)],
+                         [(13, 2048, None), (14, 10, None)])
+
+
+
+class BodyStructureTest(unittest.TestCase):
+
+    def setUp(self):
+        data = [(b"1 (UID 7 BODYSTRUCTURE " + BODYSTRUCTURE + b" BODY[HEADER] {%d}" % len(HEADER), HEADER), b")"]
+        self.seq, self.fields = parse_fetch_items(data)[0]
+        self.structure = parse_bodystructure(self.fields["BODYSTRUCTURE"])
+
+    def test_parse_fetch_items(self):
+        self.assertEqual(self.seq, 1)
+        self.assertEqual(self.fields["UID"], 7)
+        self.assertEqual(self.fields["BODY[HEADER]"], HEADER)
+
+    def test_sections(self):
+        self.assertEqual(self.structure["type"], "multipart")
+        self.assertEqual(self.structure["subtype"], "mixed")
+        html, pdf, forwarded = self.structure["parts"]
+        self.assertEqual((html["section"], html["params"], html["encoding"]), ("1", {"charset": "utf-8"}, "base64"))
+        self.assertEqual(pdf["disposition"], ("attachment", {"filename": "a.pdf"}))
+        self.assertEqual(pdf["size"], 8)
+        # 转发邮件的非multipart正文编号为 3.1
+        self.assertEqual(forwarded["message"]["section"], "3.1")
+        self.assertEqual([part["section"] for part in iter_body_parts(self.structure)], ["1", "2", "3.1"])
+
+    def test_single_part_message(self):
+        structure = parse_bodystructure(parse_fetch_items(
+            [b'1 (BODYSTRUCTURE ("TEXT" "PLAIN" ("CHARSET" "gb2312") NIL NIL "7BIT" 5 1 NIL NIL NIL NIL))'])[0][1]
+            ["BODYSTRUCTURE"])
+        self.assertEqual([part["section"] for part in iter_body_parts(structure)], ["1"])
+        message = build_message(b"Subject: s\r\n\r\n", structure, list(iter_body_parts(structure)), {"1": b"hello"})
+        self.assertEqual(message.get_payload(decode=True), b"hello")
+
+    def test_build_message(self):
+        parts = list(iter_body_parts(self.structure))
+        sections = {
+            "1": base64.b64encode("<p>研报</p>".encode("utf-8")),
+            "2": base64.b64encode(b"%PDF-1.4"),
+            "3.1": b"quote",
+        }
+        message = build_message(HEADER, self.structure, parts, sections)
+        self.assertEqual(message["Subject"], "forwarded")
+        html, pdf, text = message.get_payload()
+        self.assertEqual(html.get_payload(decode=True).decode(html.get_content_charset()), "<p>研报</p>")
+        self.assertEqual(pdf.get_param("name"), "a.pdf")
+        self.assertEqual(pdf.get_filename(), "a.pdf")
+        self.assertEqual(pdf.get_payload(decode=True), b"%PDF-1.4")
+        self.assertEqual(text.get_content_type(), "text/plain")
+        self.assertEqual(text.get_payload(decode=True), b"quote")
+
+
+if __name__ == '__main__':
+    unittest.main()
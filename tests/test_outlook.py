@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+# ==============================================================================
+# @ Author :
+# @ Desc : 邮件预筛选测试
+# @ Date : 2021/5/28
+# ==============================================================================
+import email
+import unittest
+
+from fetch_core import outlook as outlook_module
+from fetch_core.outlook import EmailInfoFetch
+from utils.exceptions import IMAPCommandException
+
+
+class FakeIMAP:
+    """ imaplib.IMAP4 的 fetch 模拟: 邮件序号1~n, FETCH包含failing中的序号时返回NO """
+
+    def __init__(self, count, failing=()):
+        self.failing = set(failing)
+        self.fetched = []
+
+    def fetch(self, message_set, message_parts):
+        self.fetched.append(message_set)
+        seqs = []
+        for part in message_set.split(","):
+            start, _, end = part.partition(":")
+            seqs.extend(range(int(start), int(end or start) + 1))
+        if self.failing.intersection(seqs):
+            return "NO", [b"fetch failed"]
+        data = []
+        for seq in seqs:
+            raw = "Subject: s{}\r\n\r\nbody\r\n".format(seq).encode()
+            data.extend([("{} (RFC822 {{{}}}".format(seq, len(raw)).encode(), raw), b")"])
+        return "OK", data
+
+
+class PrefilterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.outlook = EmailInfoFetch()
+        self.checked = []
+
+        def check_email():
+            self.checked.append(self.outlook.email_message["Subject"])
+            return self.outlook.email_message["Subject"] != "skip"
+
+        self.outlook.check_email = check_email
+
+    def test_missing_headers_are_kept_as_unverified(self):
+        headers = {
+            "1": email.message_from_string("Subject: keep\r\n\r\n"),
+            "2": email.message_from_string("Subject: skip\r\n\r\n"),
+        }
+        survivors = self.outlook.prefilter_ids([b"1", b"2", b"3"], headers)
+        self.assertEqual(survivors, [b"1", b"3"])
+        self.assertEqual(self.checked, ["keep", "skip"])
+        self.assertEqual(self.outlook.unverified_ids, {"3"})
+
+    def test_unverified_ids_reset_per_call(self):
+        self.outlook.prefilter_ids([b"3"], {})
+        self.outlook.prefilter_ids([b"1"], {"1": email.message_from_string("Subject: keep\r\n\r\n")})
+        self.assertEqual(self.outlook.unverified_ids, set())
+
+    def test_fetch_and_save_fully_checks_unverified(self):
+        self.outlook.iter_emails = lambda ids: ((eid, None) for eid in ids)
+        calls = []
+        self.outlook.fetch_email_content = lambda prefiltered=False: calls.append(prefiltered)
+        original, outlook_module.FETCH_MODE = outlook_module.FETCH_MODE, "rfc822"
+        try:
+            self.assertEqual(self.outlook.fetch_and_save(["1", "3"], unverified={"3"}), 0)
+        finally:
+            outlook_module.FETCH_MODE = original
+        self.assertEqual(calls, [True, False])
+
+
+
+class IterEmailsTest(unittest.TestCase):
+
+    def test_batched_fetch(self):
+        outlook = EmailInfoFetch()
+        outlook.imap = FakeIMAP(5)
+        fetched = [(eid, message["Subject"]) for eid, message in outlook.iter_emails([1, 2, 3, 4, 5], 2, None)]
+        self.assertEqual(fetched, [(str(seq), "s{}".format(seq)) for seq in range(1, 6)])
+        self.assertEqual(outlook.imap.fetched, ["1:2", "3:4", "5"])
+
+    def test_failed_batch_raises_after_other_batches(self):
+        outlook = EmailInfoFetch()
+        outlook.imap = FakeIMAP(5, failing={3})
+        fetched = []
+        with self.assertRaises(IMAPCommandException):
+            for eid, message in outlook.iter_emails([1, 2, 3, 4, 5], 2, None):
+                fetched.append(eid)
+        self.assertEqual(fetched, ["1", "2", "5"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+# ==============================================================================
+# @ Author :
+# @ Desc : 流水线测试
+# @ Date : 2021/6/24
+# ==============================================================================
+import threading
+import unittest
+
+from fetch_core.pipeline import Pipeline, Stage
+
+
+class PipelineTest(unittest.TestCase):
+
+    def test_items_flow_through_stages(self):
+        results = []
+        lock = threading.Lock()
+
+        def collect(item, emit):
+            with lock:
+                results.append(item)
+
+        pipeline = Pipeline([
+            Stage("double", lambda item, emit: emit(item * 2), workers=2, queue_size=2),
+            Stage("collect", collect, queue_size=2),
+        ])
+        self.assertEqual(pipeline.run(range(10)), 0)
+        self.assertEqual(sorted(results), [item * 2 for item in range(10)])
+
+    def test_failed_items_are_discarded(self):
+        discarded = []
+
+        def handler(item, emit):
+            if item % 3 == 0:
+                raise ValueError(item)
+            emit(item)
+
+        pipeline = Pipeline([
+            Stage("check", handler, queue_size=2, on_error=lambda item, err: discarded.append((item, str(err)))),
+            Stage("sink", lambda item, emit: None, queue_size=2),
+        ])
+        self.assertEqual(pipeline.run(range(7)), 3)
+        self.assertEqual(discarded, [(0, "0"), (3, "3"), (6, "6")])
+
+    def test_queue_bytes_bound(self):
+        stage = Stage("sized", lambda item, emit: None, queue_size=10, queue_bytes=10, sizeof=len)
+        stage.put(b"x" * 8)
+        # 队列为空时超过上限的数据也允许放入, 否则会永远等待
+        self.assertEqual(stage.queued_bytes, 8)
+        blocked = threading.Thread(target=stage.put, args=(b"y" * 8,), daemon=True)
+        blocked.start()
+        blocked.join(0.1)
+        self.assertTrue(blocked.is_alive())
+        stage.start()
+        blocked.join(1)
+        self.assertFalse(blocked.is_alive())
+        stage.stop()
+        self.assertEqual(stage.queued_bytes, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+# ==============================================================================
+# @ Author :
+# @ Desc : Aho-Corasick多模式匹配自动机
+# @ Date : 2021/6/10
+# ==============================================================================
+from collections import deque
+
+
+class ACAutomaton:
+    """
+    Aho-Corasick自动机: 一次线性扫描文本, 找出所有模式串的出现位置
+
+    用法:
+        ac = ACAutomaton()
+        ac.add("平安银行", 1)
+        ac.build()
+        ac.find_longest("平安银行年报点评")  # [(0, 4, 1)]
+    """
+
+    def __init__(self):
+        self._goto = [{}]  # 状态转移: state -> {字符: 下一状态}
+        self._fail = [0]  # 失败指针
+        self._output = [None]  # 以该状态结尾的模式串: (模式串长度, 值)
+        self._dict_suffix = [0]  # 沿失败指针最近的一个有输出的状态
+        self._built = False
+
+    def __len__(self):
+        return sum(1 for output in self._output if output is not None)
+
+    def add(self, pattern, value):
+        """
+        添加模式串, 重复添加时保留第一次的值
+
+        :param str pattern: 模式串
+        :param value: 匹配时返回的值
+        """
+        if not pattern:
+            return
+        state = 0
+        for char in pattern:
+            next_state = self._goto[state].get(char)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto[state][char] = next_state
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append(None)
+                self._dict_suffix.append(0)
+            state = next_state
+        if self._output[state] is None:
+            self._output[state] = (len(pattern), value)
+        self._built = False
+
+    def build(self):
+        """ 广度优先构造失败指针 """
+        queue = deque()
+        for state in self._goto[0].values():
+            self._fail[state] = 0
+            queue.append(state)
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                fail = self._goto[fail].get(char, 0)
+                self._fail[next_state] = fail
+                self._dict_suffix[next_state] = fail if self._output[fail] is not None else self._dict_suffix[fail]
+        self._built = True
+
+    def iter_matches(self, text):
+        """
+        扫描文本, 返回所有匹配(包括重叠匹配)
+
+        :param str text: 待匹配文本
+        :return: 生成器, (起始位置, 结束位置, 值)
+        """
+        if not self._built:
+            self.build()
+        goto, fail, output, dict_suffix = self._goto, self._fail, self._output, self._dict_suffix
+        state = 0
+        for index, char in enumerate(text):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            matched = state if output[state] is not None else dict_suffix[state]
+            while matched:
+                length, value = output[matched]
+                yield index + 1 - length, index + 1, value
+                matched = dict_suffix[matched]
+
+    def find_longest(self, text):
+        """
+        最左最长且互不重叠的匹配(模拟分词效果, 如 "中国平安" 不会再匹配出 "平安")
+
+        :param str text: 待匹配文本
+        :return: [(起始位置, 结束位置, 值), ...]
+        :rtype: list
+        """
+        matches = sorted(self.iter_matches(text), key=lambda match: (match[0], match[0] - match[1]))
+        result = []
+        end = 0
+        for match in matches:
+            if match[0] >= end:
+                result.append(match)
+                end = match[1]
+        return result
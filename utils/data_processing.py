@@ -4,16 +4,14 @@
 # @ Desc : 数据处理工具
 # @ Date : 2021/5/17
 # ==============================================================================
-import json
+import hashlib
 import os
 import re
 import string
 import uuid
 
-import requests
-
-from fetch_core.config import ES_URL
-from utils.exceptions import ESCallException, ESRespException
+from fetch_core.config import PDF_MAX_PAGES, PDF_MAX_CHARS, PDF_LAYOUT_ANALYSIS, EXCEL_MAX_ROWS, EXCEL_MAX_CHARS
+from utils.es_tokenizer import es_tokenizer
 from utils.init_logger import get_logger
 
 logger = get_logger("data_processing")
@@ -27,6 +25,34 @@ def get_uuid4():
     return uuid.uuid4().__str__().replace("-", "")
 
 
+def get_content_key(data, suffix=""):
+    """
+    根据附件内容生成附件唯一键, 相同内容的附件得到相同的键
+
+    :param bytes data: 解码后的附件内容
+    :param str suffix: 文件类型后缀, 如 ".pdf"
+    :return: sha256前32位十六进制 + 文件类型(与原uuid+文件类型格式一致)
+    :rtype: str
+    """
+    return hashlib.sha256(data).hexdigest()[:32] + suffix
+
+
+def get_report_key(message_id, *fields):
+    """
+    生成研报唯一键: 优先使用邮件的 Message-ID, 缺失时使用邮件内容的哈希
+
+    :param str message_id: 邮件头中的 Message-ID
+    :param fields: Message-ID 缺失时参与哈希的邮件内容(标题、发件人、发件时间等)
+    :return: 32位十六进制字符串(与原uuid格式一致)
+    :rtype: str
+    """
+    if message_id:
+        source = "message-id:" + message_id.strip()
+    else:
+        source = "content:" + "\n".join(str(field) for field in fields)
+    return hashlib.sha256(source.encode("utf-8")).hexdigest()[:32]
+
+
 def remove_non_printable(s):
     return ''.join(c for c in s if c in string.printable)
 
@@ -46,37 +72,13 @@ def get_decrypted_password(key, password):
 
 def get_es_words_from_subject(subject):
     """
-    调用es拆词API得到标题词组
+    调用es拆词API得到标题词组(复用连接池和拆词缓存)
 
     :param subject: 邮件标题
     :return: 拆词词组
     :rtype: list
     """
-
-    params = {
-        "indexName": "",
-        "text": subject
-    }
-
-    logger.info("调用ES分词接口, 当前标题内容:{}".format(subject))
-    try:
-        res = requests.get(url=ES_URL, params=params)
-
-        if res.status_code != 200:
-            logger.error(res.text)
-            raise ESCallException(res.text)
-
-        # 分词结果判断
-        res_data = json.loads(res.text)
-        status = res_data.get("status")
-        if not status or status != 1:
-            raise ESRespException("返回status值不为1")
-
-        es_words = res_data.get("data")  # 拆词结果
-        return es_words
-    except requests.exceptions.RequestException as err:
-        logger.error("es call err: 调用es分词服务出错，请检查网络是否可以访问{}".format(ES_URL))
-        return []
+    return es_tokenizer.tokenize(subject)
 
 
 def get_target_info(exp, text):
@@ -112,45 +114,99 @@ def etag_rm_quotation(etag):
         return etag
 
 
-def get_pdf_data(file_abspath):
+def open_binary(source):
     """
-    读取pdf文件的页数和内容
+    以二进制只读方式打开附件
 
-    :param file_abspath: 文件绝对路径
-    :return: (页数, 内容)
-    :rtype: tuple
+    :param source: 文件绝对路径, 或内存中的附件内容(bytes/bytearray/memoryview), 或 file-like 对象
+    :return: 上下文管理器, 返回可读的二进制文件对象
     """
-    from io import StringIO
-    from pdfminer.high_level import extract_pages, extract_text_to_fp
+    from contextlib import nullcontext
+    from io import BytesIO
 
-    output_string = StringIO()
+    if isinstance(source, str):
+        return open(source, "rb")
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return BytesIO(source)
+    return nullcontext(source)
 
-    with open(file_abspath, 'rb') as in_file:
-        page_num = len(list(extract_pages(in_file)))
-        extract_text_to_fp(in_file, output_string)
 
-    logger.info("pdf附件页数:{}, 附件前300字段内容:{}...".format(page_num, output_string.getvalue().strip()[:297]))
-    return page_num, output_string.getvalue().strip()
+def get_pdf_data(file_abspath, max_pages=PDF_MAX_PAGES, max_chars=PDF_MAX_CHARS, layout=PDF_LAYOUT_ANALYSIS):
+    """
+    读取pdf文件的页数和内容, 只解析一遍文件: 逐页提取文字的同时统计页数
 
+    :param file_abspath: 文件绝对路径, 或内存中的附件内容
+    :param int max_pages: 最多提取文字的页数, 超过的页只计入页数, 为0时不限制
+    :param int max_chars: 最多保留的文字数量, 达到后余下的页只计入页数, 为0时不限制
+    :param bool layout: 是否进行版面分析, 关闭时与 extract_text_to_fp 默认(laparams=None)的输出一致
+    :return: (页数, 内容)
+    :rtype: tuple
+    """
+    from io import StringIO
+    from pdfminer.converter import TextConverter
+    from pdfminer.layout import LAParams
+    from pdfminer.pdfinterp import PDFResourceManager, PDFPageInterpreter
+    from pdfminer.pdfpage import PDFPage
 
-def get_excel_data(file_abspath):
+    output_string = StringIO()
+    page_num = 0
+
+    with open_binary(file_abspath) as in_file:
+        rsrcmgr = PDFResourceManager(caching=True)
+        device = TextConverter(rsrcmgr, output_string, laparams=LAParams() if layout else None)
+        interpreter = PDFPageInterpreter(rsrcmgr, device)
+        try:
+            for page in PDFPage.get_pages(in_file, caching=True):
+                page_num += 1
+                if (max_pages and page_num > max_pages) or (max_chars and output_string.tell() >= max_chars):
+                    continue
+                interpreter.process_page(page)
+        finally:
+            device.close()
+
+    result = output_string.getvalue().strip()
+    if max_chars:
+        result = result[:max_chars]
+    logger.info("pdf附件页数:{}, 附件前300字段内容:{}...".format(page_num, result[:297]))
+    return page_num, result
+
+
+def get_excel_data(file_abspath, max_rows=EXCEL_MAX_ROWS, max_chars=EXCEL_MAX_CHARS):
     """
-    读取Excel文档所有内容
+    读取Excel文档所有工作表的内容(只读模式逐行读取, 不在内存中构建完整的单元格对象)
+
+    每行去掉空单元格后写成 ('a', 1) 的形式, 达到行数或字数上限后停止读取
 
-    :param file_abspath: 文件绝对路径
+    :param file_abspath: 文件绝对路径, 或内存中的附件内容
+    :param int max_rows: 最多读取的行数(所有工作表合计), 为0时不限制
+    :param int max_chars: 最多保留的文字数量, 为0时不限制
     :return: 文档所有内容字符串拼接
     """
     import openpyxl
-    from io import StringIO
+    from io import BytesIO, StringIO
+    from itertools import chain
 
     output_string = StringIO()
-    wb_obj = openpyxl.load_workbook(filename=file_abspath)
-    sheet_obj = wb_obj.active
-
-    for i in sheet_obj.values:
-        output_string.write(str(i))
-
-    result = output_string.getvalue().replace("None, ", "").replace("None", "")
+    if isinstance(file_abspath, (bytes, bytearray, memoryview)):
+        file_abspath = BytesIO(file_abspath)
+    wb_obj = openpyxl.load_workbook(filename=file_abspath, read_only=True)
+    rows = 0
+    try:
+        all_rows = chain.from_iterable(sheet_obj.iter_rows(values_only=True) for sheet_obj in wb_obj.worksheets)
+        for row in all_rows:
+            cells = [repr(value) for value in row if value is not None]
+            if not cells:
+                continue
+            output_string.write("(" + ", ".join(cells) + ")")
+            rows += 1
+            if (max_rows and rows >= max_rows) or (max_chars and output_string.tell() >= max_chars):
+                break
+    finally:
+        wb_obj.close()
+
+    result = output_string.getvalue()
+    if max_chars:
+        result = result[:max_chars]
     logger.info("xlsx附件前300字段内容:{}...".format(result[:297]))
 
     return result
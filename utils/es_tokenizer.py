@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+# ==============================================================================
+# @ Author :
+# @ Desc : ES拆词接口客户端(连接池 + 超时 + LRU缓存)
+# @ Date : 2021/6/11
+# ==============================================================================
+import json
+import threading
+import time
+from collections import OrderedDict
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from fetch_core.config import ES_URL, ES_POOL_SIZE, ES_CONNECT_TIMEOUT, ES_READ_TIMEOUT, ES_CACHE_SIZE
+from utils.exceptions import ESCallException, ESRespException
+from utils.init_logger import get_logger
+
+logger = get_logger("es_tokenizer")
+
+
+class ESTokenizer:
+    """ 复用keep-alive连接的ES拆词客户端, 相同标题只请求一次 """
+
+    def __init__(self, url=ES_URL, pool_size=ES_POOL_SIZE, connect_timeout=ES_CONNECT_TIMEOUT,
+                 read_timeout=ES_READ_TIMEOUT, cache_size=ES_CACHE_SIZE):
+        self.url = url
+        self.timeout = (connect_timeout, read_timeout)
+        self.cache_size = cache_size
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        # 统计
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+        self.latency = 0.0  # 请求ES的累计耗时, 单位秒
+
+    def _request(self, subject):
+        params = {
+            "indexName": "",
+            "text": subject
+        }
+        logger.info("调用ES分词接口, 当前标题内容:{}".format(subject))
+        start = time.perf_counter()
+        try:
+            res = self.session.get(url=self.url, params=params, timeout=self.timeout)
+        finally:
+            with self._lock:
+                self.latency += time.perf_counter() - start
+
+        if res.status_code != 200:
+            logger.error(res.text)
+            raise ESCallException(res.text)
+
+        # 分词结果判断
+        res_data = json.loads(res.text)
+        status = res_data.get("status")
+        if not status or status != 1:
+            raise ESRespException("返回status值不为1")
+
+        return res_data.get("data")  # 拆词结果
+
+    def tokenize(self, subject):
+        """
+        标题拆词, 优先读取缓存; 请求失败时返回空列表且不缓存
+
+        :param str subject: 邮件标题
+        :return: 拆词词组
+        :rtype: list
+        """
+        with self._lock:
+            words = self._cache.get(subject)
+            if words is not None:
+                self._cache.move_to_end(subject)
+                self.hits += 1
+                return list(words)
+            self.misses += 1
+
+        try:
+            words = self._request(subject) or []
+        except requests.exceptions.RequestException as err:
+            with self._lock:
+                self.errors += 1
+            logger.error("es call err: 调用es分词服务出错，请检查网络是否可以访问{}, 错误信息: {}".format(self.url, err))
+            return []
+
+        with self._lock:
+            self._cache[subject] = tuple(words)
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return list(words)
+
+    def stats(self):
+        """
+        :return: 缓存命中/未命中次数、请求失败次数、请求平均耗时(毫秒)
+        :rtype: dict
+        """
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "errors": self.errors,
+                "avg_latency_ms": round(self.latency * 1000 / self.misses, 2) if self.misses else 0,
+            }
+
+    def log_stats(self):
+        stats = self.stats()
+        if stats["hits"] or stats["misses"]:
+            logger.info("ES拆词统计: 命中 {hits} 次, 未命中 {misses} 次, 失败 {errors} 次, 平均耗时 {avg_latency_ms}ms"
+                        .format(**stats))
+
+
+es_tokenizer = ESTokenizer()
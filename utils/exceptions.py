@@ -44,3 +44,29 @@ class ESRespException(Exception):
 
     def __str__(self):
         return "es api return err: {}".format(self._err_msg)
+
+
+class IMAPCommandException(Exception):
+    def __init__(self, err_msg: Optional[str]):
+        """
+        IMAP命令执行异常
+
+        :param err_msg: 错误消息
+        """
+        self._err_msg = err_msg
+
+    def __str__(self):
+        return "imap command err: {}".format(self._err_msg)
+
+
+class SpoolQuotaException(Exception):
+    def __init__(self, err_msg: Optional[str]):
+        """
+        本地附件目录超出磁盘配额
+
+        :param err_msg: 错误消息
+        """
+        self._err_msg = err_msg
+
+    def __str__(self):
+        return "attachment spool quota exceeded: {}".format(self._err_msg)
@@ -0,0 +1,310 @@
+# -*- coding: utf-8 -*-
+# ==============================================================================
+# @ Author :
+# @ Desc : IMAP协议相关工具
+# @ Date : 2021/6/2
+# ==============================================================================
+import email
+import email.message
+import email.utils
+import re
+
+_FETCH_START = re.compile(rb"^(\d+) \(")
+_FETCH_UID = re.compile(rb"UID (\d+)")
+_FETCH_SIZE = re.compile(rb"RFC822\.SIZE (\d+)")
+
+
+def _update_fetch_item(item, meta):
+    """ 从FETCH响应的描述部分提取UID和邮件大小 """
+    uid = _FETCH_UID.search(meta)
+    if uid:
+        item["uid"] = int(uid.group(1))
+    size = _FETCH_SIZE.search(meta)
+    if size:
+        item["size"] = int(size.group(1))
+
+
+def parse_fetch_response(data):
+    """
+    解析imaplib批量FETCH返回的数据
+
+    imaplib 对带字面量(literal)的响应返回 (描述, 内容) 元组, 其后跟随 b")" 或 b" UID 5)" 这样的收尾片段;
+    不带字面量的响应(如只取 RFC822.SIZE)直接返回 bytes。
+
+    :param list data: imaplib fetch/uid 返回的 data
+    :return: [{"seq": 序号, "uid": uid, "size": 邮件大小, "literal": 内容}, ...]
+    :rtype: list
+    """
+    items = []
+    for part in data:
+        if part is None:
+            continue
+        if isinstance(part, tuple):
+            meta, literal = part[0], part[1]
+        else:
+            meta, literal = part, None
+
+        matched = _FETCH_START.match(meta)
+        if matched:
+            item = {"seq": int(matched.group(1)), "uid": None, "size": None, "literal": literal}
+            items.append(item)
+        elif items:
+            # 收尾片段属于上一封邮件
+            item = items[-1]
+        else:
+            continue
+        _update_fetch_item(item, meta)
+    return items
+
+
+def compress_id_set(ids):
+    """
+    将邮件id列表压缩为IMAP序列集, 如 [1, 2, 3, 5, 7, 8] -> "1:3,5,7:8"
+
+    :param list ids: 邮件id列表(bytes/str/int)
+    :return: 序列集字符串
+    :rtype: str
+    """
+    numbers = sorted({int(eid) for eid in ids})
+    ranges = []
+    for number in numbers:
+        if ranges and ranges[-1][1] + 1 == number:
+            ranges[-1][1] = number
+        else:
+            ranges.append([number, number])
+    return ",".join(str(start) if start == end else "{}:{}".format(start, end) for start, end in ranges)
+
+
+def chunk_ids(ids, batch_size, byte_budget=None, sizes=None):
+    """
+    按数量和字节预算对邮件id分批, 超过字节预算的单封邮件单独成批
+
+    :param list ids: 邮件id列表
+    :param int batch_size: 每批最多邮件数量
+    :param int byte_budget: 每批最多字节数, None表示不限制
+    :param dict sizes: {str(id): 邮件大小}, 缺失的邮件按0计算
+    :return: 分批后的邮件id列表
+    :rtype: list
+    """
+    sizes = sizes or {}
+    batches = []
+    batch, batch_bytes = [], 0
+    for eid in ids:
+        size = sizes.get(eid.decode() if isinstance(eid, bytes) else str(eid), 0)
+        over_budget = byte_budget is not None and batch and batch_bytes + size > byte_budget
+        if len(batch) >= batch_size or over_budget:
+            batches.append(batch)
+            batch, batch_bytes = [], 0
+        batch.append(eid)
+        batch_bytes += size
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def _parse_list(data, pos=0):
+    """
+    解析IMAP响应中的括号列表, 如 (UID 5 BODY[1] {3}\r\nabc)
+
+    :return: (元素列表, 结束位置); NIL -> None, 数字 -> int, 字符串/字面量/其它原子 -> bytes
+    """
+    items = []
+    length = len(data)
+    while pos < length:
+        char = data[pos:pos + 1]
+        if char in b" \r\n":
+            pos += 1
+        elif char == b"(":
+            sub, pos = _parse_list(data, pos + 1)
+            items.append(sub)
+        elif char == b")":
+            return items, pos + 1
+        elif char == b'"':
+            pos += 1
+            value = bytearray()
+            while pos < length and data[pos:pos + 1] != b'"':
+                if data[pos:pos + 1] == b"\\":
+                    pos += 1
+                value += data[pos:pos + 1]
+                pos += 1
+            items.append(bytes(value))
+            pos += 1
+        elif char == b"{":
+            end = data.index(b"}", pos)
+            size = int(data[pos + 1:end])
+            pos = end + 1
+            if data[pos:pos + 2] == b"\r\n":
+                pos += 2
+            items.append(data[pos:pos + size])
+            pos += size
+        else:
+            # 原子, 方括号内允许出现空格和括号, 如 BODY[HEADER.FIELDS (DATE FROM)]
+            start, depth = pos, 0
+            while pos < length:
+                char = data[pos:pos + 1]
+                if char == b"[":
+                    depth += 1
+                elif char == b"]":
+                    depth -= 1
+                elif depth <= 0 and char in b' ()"\r\n':
+                    break
+                pos += 1
+            atom = data[start:pos]
+            if atom.upper() == b"NIL":
+                items.append(None)
+            elif atom.isdigit():
+                items.append(int(atom))
+            else:
+                items.append(atom)
+    return items, pos
+
+
+def parse_fetch_items(data):
+    """
+    解析imaplib批量FETCH返回的数据, 按数据项名称返回每封邮件的所有数据项(支持一封邮件有多个字面量)
+
+    :param list data: imaplib fetch/uid 返回的 data
+    :return: [(序号, {"UID": 5, "BODYSTRUCTURE": [...], "BODY[1]": b"...", ...}), ...]
+    :rtype: list
+    """
+    responses = []
+    for part in data:
+        if part is None:
+            continue
+        if isinstance(part, tuple):
+            meta, chunk = part[0], part[0] + b"\r\n" + part[1]
+        else:
+            meta, chunk = part, part
+        if _FETCH_START.match(meta):
+            responses.append(bytearray(chunk))
+        elif responses:
+            # 收尾片段或后续字面量属于上一封邮件
+            responses[-1] += chunk
+
+    items = []
+    for response in responses:
+        tokens, _ = _parse_list(bytes(response))
+        if len(tokens) < 2 or not isinstance(tokens[1], list):
+            continue
+        values = tokens[1]
+        fields = {}
+        for index in range(0, len(values) - 1, 2):
+            name = values[index]
+            if isinstance(name, bytes):
+                fields[name.decode("ascii", "replace").upper()] = values[index + 1]
+        items.append((tokens[0], fields))
+    return items
+
+
+def _to_text(value):
+    if value is None:
+        return None
+    if isinstance(value, bytes):
+        return value.decode("utf-8", "replace")
+    return str(value)
+
+
+def _to_params(value):
+    """ ("NAME" "a.pdf" "CHARSET" "utf-8") -> {"name": "a.pdf", "charset": "utf-8"} """
+    if not isinstance(value, list):
+        return {}
+    return {_to_text(value[index]).lower(): _to_text(value[index + 1]) for index in range(0, len(value) - 1, 2)}
+
+
+def parse_bodystructure(body, section=""):
+    """
+    将BODYSTRUCTURE解析为邮件结构
+
+    :param list body: parse_fetch_items 返回的 BODYSTRUCTURE 值
+    :param str section: 当前部分的section编号, 顶层为空
+    :return: 多部分: {"section", "type": "multipart", "subtype", "parts": [...]};
+             单个部分: {"section", "type", "subtype", "params", "encoding", "size", "disposition"},
+             message/rfc822(转发的邮件)另有 "message": 内嵌邮件的结构
+    :rtype: dict
+    """
+    if body and isinstance(body[0], list):
+        parts = []
+        index = 0
+        while index < len(body) and isinstance(body[index], list):
+            child_section = "{}.{}".format(section, index + 1) if section else str(index + 1)
+            parts.append(parse_bodystructure(body[index], child_section))
+            index += 1
+        subtype = _to_text(body[index]) if index < len(body) else "mixed"
+        return {"section": section, "type": "multipart", "subtype": (subtype or "mixed").lower(), "parts": parts}
+
+    content_type = (_to_text(body[0]) or "text").lower()
+    subtype = (_to_text(body[1]) or "plain").lower()
+    # 基本字段: 类型 子类型 参数 id 描述 编码 大小, text 多一个行数, message/rfc822 多 信封 邮件结构 行数
+    extension = 7
+    if content_type == "text":
+        extension += 1
+    elif content_type == "message" and subtype == "rfc822":
+        extension += 3
+    disposition = body[extension + 1] if len(body) > extension + 1 else None
+    if isinstance(disposition, list) and disposition:
+        disposition = ((_to_text(disposition[0]) or "").lower(), _to_params(disposition[1] if len(disposition) > 1 else None))
+    else:
+        disposition = None
+    structure = {
+        "section": section or "1",
+        "type": content_type,
+        "subtype": subtype,
+        "params": _to_params(body[2]),
+        "encoding": (_to_text(body[5]) or "7bit").lower(),
+        "size": body[6] if isinstance(body[6], int) else 0,
+        "disposition": disposition,
+    }
+    if content_type == "message" and subtype == "rfc822" and len(body) > 8 and isinstance(body[8], list):
+        # 内嵌邮件的部分编号在本部分之下: 多部分时为 n.1, n.2 ..., 单个部分时为 n.1
+        message = parse_bodystructure(body[8], structure["section"])
+        if message["type"] != "multipart":
+            message["section"] = structure["section"] + ".1"
+        structure["message"] = message
+    return structure
+
+
+def iter_body_parts(structure):
+    """ 按顺序返回邮件结构中所有非multipart的部分, 与 Message.walk() 一致会进入转发的邮件(message/rfc822)内部 """
+    if structure["type"] == "multipart":
+        for part in structure["parts"]:
+            yield from iter_body_parts(part)
+    elif "message" in structure:
+        yield from iter_body_parts(structure["message"])
+    else:
+        yield structure
+
+
+def _header_value(value, params):
+    segments = [value]
+    for key, param in params.items():
+        segments.append('{}="{}"'.format(key, email.utils.quote(param or "")))
+    return "; ".join(segments)
+
+
+def build_message(header, structure, parts, sections):
+    """
+    由邮件头、邮件结构和按section下载的内容构造 email.message.Message, 供原有的正文和附件处理使用
+
+    :param bytes header: BODY[HEADER]
+    :param dict structure: parse_bodystructure 返回的邮件结构
+    :param list parts: 需要的部分(iter_body_parts 返回的元素)
+    :param dict sections: {section: 未解码的部分内容}
+    :return: 多部分邮件(包括转发邮件内)的各部分作为顶层邮件的直接子部分, 传输编码在 get_payload(decode=True) 时解码
+    :rtype: email.message.Message
+    """
+    message = email.message_from_bytes(header)
+    if structure["type"] != "multipart" and "message" not in structure:
+        message.set_payload(sections.get(structure["section"], b"").decode("ascii", "surrogateescape"))
+        return message
+
+    payload = []
+    for part in parts:
+        part_message = email.message.Message()
+        part_message["Content-Type"] = _header_value("{}/{}".format(part["type"], part["subtype"]), part["params"])
+        part_message["Content-Transfer-Encoding"] = part["encoding"]
+        if part["disposition"]:
+            part_message["Content-Disposition"] = _header_value(*part["disposition"])
+        part_message.set_payload(sections.get(part["section"], b"").decode("ascii", "surrogateescape"))
+        payload.append(part_message)
+    message.set_payload(payload)
+    return message